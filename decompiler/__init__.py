@@ -20,12 +20,13 @@
 
 
 from .util import DecompilerBase, First, WordConcatenator, reconstruct_paraminfo, \
-                  reconstruct_arginfo, string_escape, split_logical_lines, Dispatcher, \
-                  say_get_code, OptionBase
+                  reconstruct_arginfo, string_escape, iter_logical_lines, Dispatcher, \
+                  say_get_code, OptionBase, ListWriter, _State
 from .renpycompat import renpy
 
 from operator import itemgetter
-from io import StringIO
+from collections import Counter
+from functools import lru_cache
 
 from . import sl2decompiler
 from . import testcasedecompiler
@@ -52,8 +53,57 @@ class Options(OptionBase):
 def pprint(out_file, ast, options=Options()):
     Decompiler(out_file, options).dump(ast)
 
+# Ren'Py 8.4.0兼容性：较新的版本不再在pickle中存储值为默认值的属性。
+# 此表列出了各打印方法依赖的属性及其默认值。默认值为list时每个节点得到一个新的空列表
+_NODE_DEFAULTS = {
+    renpy.ast.Show: (("atl", None), ("imspec", None), ("layer", None), ("at_list", list),
+                     ("onlayer", None), ("behind", list), ("zorder", None), ("as_", None)),
+    renpy.ast.Scene: (("atl", None), ("imspec", None), ("layer", None), ("onlayer", None)),
+    renpy.ast.With: (("paired", None), ("expr", None)),
+    renpy.ast.Label: (("parameters", None), ("block", list)),
+    renpy.ast.Jump: (("target", None), ("expression", False)),
+    renpy.ast.Return: (("expression", None),),
+    renpy.ast.Say: (("who", None), ("what", None), ("with_", None), ("interact", True),
+                    ("attributes", None), ("temporary_attributes", None), ("rollback", None)),
+}
+
+def _make_normalizer(defaults):
+    def normalize(ast):
+        d = ast.__dict__
+        for attr, default in defaults:
+            if attr not in d:
+                d[attr] = [] if default is list else default
+    return normalize
+
+# 每个AST类一个在导入时构建的规范化函数，用于补全缺失的属性
+_normalizers = {cls: _make_normalizer(defaults) for cls, defaults in _NODE_DEFAULTS.items()}
+
+# 同一个图像名称在脚本中通常会出现很多次。图像名称是字符串元组，可以直接作为缓存键
+@lru_cache(maxsize=1024)
+def _join_image_name(name):
+    return " ".join(name)
+
+# renpy.ast.X每次访问都要经过FakePackage.__getattr__，所以isinstance检查中用到的类在这里解析一次。
+# 注意伪类与反序列化出的类只是相等而非同一对象，所以不能用`is`比较
+_Call = renpy.ast.Call
+_Init = renpy.ast.Init
+_Label = renpy.ast.Label
+_Menu = renpy.ast.Menu
+_PyExpr = renpy.ast.PyExpr
+_Python = renpy.ast.Python
+_Say = renpy.ast.Say
+_Style = renpy.ast.Style
+_TranslateString = renpy.ast.TranslateString
+_UserStatement = renpy.ast.UserStatement
+_With = renpy.ast.With
+
 # 实现
 
+class _DecompilerState(_State):
+    __slots__ = ('paired_with', 'say_inside_menu', 'label_inside_menu', 'in_init',
+                 'missing_init', 'most_lines_behind', 'last_lines_behind')
+
+
 class Decompiler(DecompilerBase):
     """
     处理将renpy AST反编译到给定流的对象
@@ -62,6 +112,7 @@ class Decompiler(DecompilerBase):
     # 这个字典是Class: unbound_method的映射，用于确定
     # 为哪个ast类调用什么方法
     dispatch = Dispatcher()
+    state_class = _DecompilerState
 
     def __init__(self, out_file, options):
         super(Decompiler, self).__init__(out_file, options)
@@ -75,29 +126,47 @@ class Decompiler(DecompilerBase):
         self.most_lines_behind = 0
         self.last_lines_behind = 0
 
+        # 每个实例预先把dispatch中的未绑定方法解析为绑定方法，
+        # 这样print_node中每个节点只需一次字典查找
+        self._dispatch_local = {cls: func.__get__(self, type(self))
+                                for cls, func in self.dispatch.items()}
+
+        # should_come_before和say_belongs_to_menu会对同一对节点重复求值。
+        # 反编译期间AST节点一直存活，所以可以安全地用id()作为键，dump结束时清除
+        self._scb_cache = {}
+        self._sbtm_cache = {}
+
     def advance_to_line(self, linenumber):
-        self.last_lines_behind = max(
-            self.linenumber + (0 if self.skip_indent_until_write else 1) - linenumber, 0)
-        self.most_lines_behind = max(self.last_lines_behind, self.most_lines_behind)
-        super(Decompiler, self).advance_to_line(linenumber)
+        behind = self.linenumber - linenumber
+        if not self.skip_indent_until_write:
+            behind += 1
+        if behind < 0:
+            behind = 0
+        self.last_lines_behind = behind
+        if behind > self.most_lines_behind:
+            self.most_lines_behind = behind
+        DecompilerBase.advance_to_line(self, linenumber)
 
     def save_state(self):
-        return (super(Decompiler, self).save_state(), self.paired_with, self.say_inside_menu,
-                self.label_inside_menu, self.in_init, self.missing_init, self.most_lines_behind,
-                self.last_lines_behind)
-
-    def commit_state(self, state):
-        super(Decompiler, self).commit_state(state[0])
+        state = super(Decompiler, self).save_state()
+        state.paired_with = self.paired_with
+        state.say_inside_menu = self.say_inside_menu
+        state.label_inside_menu = self.label_inside_menu
+        state.in_init = self.in_init
+        state.missing_init = self.missing_init
+        state.most_lines_behind = self.most_lines_behind
+        state.last_lines_behind = self.last_lines_behind
+        return state
 
     def rollback_state(self, state):
-        self.paired_with = state[1]
-        self.say_inside_menu = state[2]
-        self.label_inside_menu = state[3]
-        self.in_init = state[4]
-        self.missing_init = state[5]
-        self.most_lines_behind = state[6]
-        self.last_lines_behind = state[7]
-        super(Decompiler, self).rollback_state(state[0])
+        self.paired_with = state.paired_with
+        self.say_inside_menu = state.say_inside_menu
+        self.label_inside_menu = state.label_inside_menu
+        self.in_init = state.in_init
+        self.missing_init = state.missing_init
+        self.most_lines_behind = state.most_lines_behind
+        self.last_lines_behind = state.last_lines_behind
+        super(Decompiler, self).rollback_state(state)
 
     def dump(self, ast):
         if self.options.translator:
@@ -106,24 +175,43 @@ class Decompiler(DecompilerBase):
         if self.options.init_offset and isinstance(ast, (tuple, list)):
             self.set_best_init_offset(ast)
 
-        # skip_indent_until_write避免初始空行
-        super(Decompiler, self).dump(ast, skip_indent_until_write=True)
-        # 如果有我们想要写出但还没有写的内容，现在就写
-        for m in self.blank_line_queue:
-            m(None)
-        self.write("\n# 由unrpyc反编译: https://github.com/CensoredUsername/unrpyc\n")
+        # 输出先收集在内存中，结束时一次写入文件，和AstDumper一样
+        out_file = self.out_file
+        buffer = self.out_file = ListWriter()
+        try:
+            # skip_indent_until_write避免初始空行
+            super(Decompiler, self).dump(ast, skip_indent_until_write=True)
+            # 如果有我们想要写出但还没有写的内容，现在就写
+            queue = self.blank_line_queue
+            if queue:
+                for m in queue:
+                    m(None)
+            self.write("\n# 由unrpyc反编译: https://github.com/CensoredUsername/unrpyc\n")
+        finally:
+            self._scb_cache.clear()
+            self._sbtm_cache.clear()
+            # 如果在print_menu的尝试中失败，self.out_file仍是尝试用的StringIO，
+            # 因此总是写出最外层的缓冲区，保留失败之前的所有内容
+            out_file.write(buffer.getvalue())
+            self.out_file = out_file
         assert not self.missing_init, "缺少必需的init、init标签或translate块"
 
+    # 我们在它们的打印方法中为这些类型特殊处理行前进，
+    # 所以print_node中不要为它们前进行
+    _skip_advance_types = frozenset((renpy.ast.TranslateString, renpy.ast.With,
+                                     renpy.ast.Label, renpy.ast.Pass, renpy.ast.Return))
+
     def print_node(self, ast):
-        # 我们在它们的打印方法中为某些类型特殊处理行前进，
-        # 所以这里不要为它们前进行
-        if hasattr(ast, 'linenumber') and not isinstance(
-                ast, (renpy.ast.TranslateString, renpy.ast.With, renpy.ast.Label,
-                      renpy.ast.Pass, renpy.ast.Return)
-                ):
+        t = type(ast)
+        if t not in self._skip_advance_types and hasattr(ast, 'linenumber'):
             self.advance_to_line(ast.linenumber)
 
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        # 未知节点很少见，所以命中路径上不需要.get()的默认值处理
+        try:
+            method = self._dispatch_local[t]
+        except KeyError:
+            method = self.print_unknown
+        method(ast)
 
     # ATL子反编译器钩子
 
@@ -136,13 +224,16 @@ class Decompiler(DecompilerBase):
 
     # 可显示相关函数
 
-    def print_imspec(self, imspec):
+    def format_imspec(self, imspec):
+        # 返回imspec的文本，以及其后的内容是否需要一个分隔空格
         if imspec[1] is not None:
             begin = f'expression {imspec[1]}'
         else:
-            begin = " ".join(imspec[0])
+            begin = _join_image_name(tuple(imspec[0]))
 
-        words = WordConcatenator(begin and begin[-1] != ' ', True)
+        # 只有6.17之前的ren'py才会在simple_expression后面留下空白，
+        # 而那些版本不受支持，所以这里不需要WordConcatenator
+        words = []
         if imspec[2] is not None:
             words.append(f'as {imspec[2]}')
 
@@ -158,14 +249,18 @@ class Decompiler(DecompilerBase):
         if len(imspec[3]) > 0:
             words.append(f'at {", ".join(imspec[3])}')
 
-        self.write(begin + words.join())
-        return words.needs_space
+        needs_space = bool(begin) and begin[-1] != ' '
+        if not words:
+            return begin, needs_space
+
+        tail = " ".join(words)
+        return (f'{begin} {tail}' if needs_space else begin + tail), True
 
     @dispatch(renpy.ast.Image)
     def print_image(self, ast):
         self.require_init()
         self.indent()
-        self.write(f'image {" ".join(ast.imgname)}')
+        self.write(f'image {_join_image_name(tuple(ast.imgname))}')
         if ast.code is not None:
             self.write(f' = {ast.code.source}')
         else:
@@ -181,7 +276,7 @@ class Decompiler(DecompilerBase):
         # 如果我们有一个具有非默认优先级的隐式init块，我们需要在这里
         # 存储优先级。
         priority = ""
-        if isinstance(self.parent, renpy.ast.Init):
+        if isinstance(self.parent, _Init):
             init = self.parent
             if (init.priority != self.init_offset
                     and len(init.block) == 1
@@ -200,38 +295,25 @@ class Decompiler(DecompilerBase):
 
     @dispatch(renpy.ast.Show)
     def print_show(self, ast):
-        # 应用Ren'Py 8.4.0兼容性默认值
-        if not hasattr(ast, 'atl'):
-            ast.atl = None
-        if not hasattr(ast, 'imspec'):
-            ast.imspec = None
-        if not hasattr(ast, 'layer'):
-            ast.layer = None
-        if not hasattr(ast, 'at_list'):
-            ast.at_list = []
-        if not hasattr(ast, 'onlayer'):
-            ast.onlayer = None
-        if not hasattr(ast, 'behind'):
-            ast.behind = []
-        if not hasattr(ast, 'zorder'):
-            ast.zorder = None
-        if not hasattr(ast, 'as_'):
-            ast.as_ = None
-            
+        _normalizers[type(ast)](ast)
+
         self.indent()
-        self.write("show ")
-        needs_space = self.print_imspec(ast.imspec)
+        imspec, needs_space = self.format_imspec(ast.imspec)
+        parts = ["show ", imspec]
 
         if self.paired_with:
             if needs_space:
-                self.write(" ")
-            self.write(f'with {self.paired_with}')
+                parts.append(" ")
+            parts.append(f'with {self.paired_with}')
             self.paired_with = True
 
         # atl attribute: since 6.10
         if ast.atl is not None:
-            self.write(":")
+            parts.append(":")
+            self.write("".join(parts))
             self.print_atl(ast.atl)
+        else:
+            self.write("".join(parts))
 
     @dispatch(renpy.ast.ShowLayer)
     def print_showlayer(self, ast):
@@ -247,114 +329,113 @@ class Decompiler(DecompilerBase):
 
     @dispatch(renpy.ast.Scene)
     def print_scene(self, ast):
-        # 应用Ren'Py 8.4.0兼容性默认值
-        if not hasattr(ast, 'atl'):
-            ast.atl = None
-        if not hasattr(ast, 'imspec'):
-            ast.imspec = None
-        if not hasattr(ast, 'layer'):
-            ast.layer = None
-        if not hasattr(ast, 'onlayer'):
-            ast.onlayer = None
-            
+        _normalizers[type(ast)](ast)
+
         self.indent()
-        self.write("scene")
+        parts = ["scene"]
 
         if ast.imspec is None:
             if isinstance(ast.layer, str):
-                self.write(f' onlayer {ast.layer}')
+                parts.append(f' onlayer {ast.layer}')
             needs_space = True
         else:
-            self.write(" ")
-            needs_space = self.print_imspec(ast.imspec)
+            imspec, needs_space = self.format_imspec(ast.imspec)
+            parts.append(" ")
+            parts.append(imspec)
 
         if self.paired_with:
             if needs_space:
-                self.write(" ")
-            self.write(f'with {self.paired_with}')
+                parts.append(" ")
+            parts.append(f'with {self.paired_with}')
             self.paired_with = True
 
         # atl attribute: since 6.10
         if ast.atl is not None:
-            self.write(":")
+            parts.append(":")
+            self.write("".join(parts))
             self.print_atl(ast.atl)
+        else:
+            self.write("".join(parts))
 
     @dispatch(renpy.ast.Hide)
     def print_hide(self, ast):
         self.indent()
-        self.write("hide ")
-        needs_space = self.print_imspec(ast.imspec)
+        imspec, needs_space = self.format_imspec(ast.imspec)
         if self.paired_with:
-            if needs_space:
-                self.write(" ")
-            self.write(f'with {self.paired_with}')
+            self.write(f'hide {imspec}{" " if needs_space else ""}with {self.paired_with}')
             self.paired_with = True
+        else:
+            self.write(f'hide {imspec}')
 
     @dispatch(renpy.ast.With)
     def print_with(self, ast):
-        # Apply defaults for Ren'Py 8.4.0 compatibility
-        if not hasattr(ast, 'paired'):
-            ast.paired = None
-        if not hasattr(ast, 'expr'):
-            ast.expr = None
-            
+        _normalizers[type(ast)](ast)
+
+        # 按(是否有paired, 是否在配对的with中)选择处理方法
+        key = (ast.paired is not None) << 1 | bool(self.paired_with)
+        self._with_handlers[key](self, ast)
+
+    def _print_with_standalone(self, ast):
+        self.advance_to_line(ast.linenumber)
+        self.indent()
+        self.write(f'with {ast.expr}')
+        self.paired_with = False
+
+    # paired_with属性自6.7.1以来
+    def _print_with_suffix(self, ast):
+        # 检查它是否被show/scene语句消耗了
+        if self.paired_with is not True:
+            self.write(f' with {ast.expr}')
+        self.paired_with = False
+
+    def _print_with_paired(self, ast):
         # 'paired'属性表示这个with
         # 和之后的with节点是后缀
         # with语句的一部分。检测这个并正确处理它
-        if ast.paired is not None:
-            # 健全性检查。检查是否有匹配的with语句在再往后两个节点
-            if not (isinstance(self.block[self.index + 2], renpy.ast.With)
-                    and self.block[self.index + 2].expr == ast.paired):
-                raise Exception(f'Unmatched paired with {self.paired_with!r} != {ast.expr!r}')
-
-            self.paired_with = ast.paired
-
-        # paired_with属性自6.7.1以来
-        elif self.paired_with:
-            # 检查它是否被show/scene语句消耗了
-            if self.paired_with is not True:
-                self.write(f' with {ast.expr}')
-            self.paired_with = False
-        else:
-            self.advance_to_line(ast.linenumber)
-            self.indent()
-            self.write(f'with {ast.expr}')
-            self.paired_with = False
+        # 健全性检查。检查是否有匹配的with语句在再往后两个节点
+        if not (isinstance(self.block[self.index + 2], _With)
+                and self.block[self.index + 2].expr == ast.paired):
+            raise Exception(f'Unmatched paired with {self.paired_with!r} != {ast.expr!r}')
+
+        self.paired_with = ast.paired
+
+    _with_handlers = (_print_with_standalone, _print_with_suffix,
+                      _print_with_paired, _print_with_paired)
 
     @dispatch(renpy.ast.Camera)
     def print_camera(self, ast):
         self.indent()
-        self.write("camera")
+        parts = ["camera"]
 
         # Apply defaults for Ren'Py 8.4.0 compatibility
-        layer = getattr(ast, 'layer', 'master')
+        layer = ast.__dict__.get('layer', 'master')
         if layer is None:
             layer = 'master'
 
         if layer != "master":
-            self.write(f' {layer}')
+            parts.append(f' {layer}')
 
         if ast.at_list:
-            self.write(f' at {", ".join(ast.at_list)}')
+            parts.append(f' at {", ".join(ast.at_list)}')
 
         if ast.atl is not None:
-            self.write(":")
+            parts.append(":")
+            self.write("".join(parts))
             self.print_atl(ast.atl)
+        else:
+            self.write("".join(parts))
 
     # 流程控制
 
     @dispatch(renpy.ast.Label)
     def print_label(self, ast):
-        # Apply defaults for Ren'Py 8.4.0 compatibility
-        if not hasattr(ast, 'parameters'):
-            ast.parameters = None
+        _normalizers[type(ast)](ast)
+        # 8.4.0将name重命名为_name
         if not hasattr(ast, 'name'):
             ast.name = getattr(ast, '_name', None)
-        if not hasattr(ast, 'block'):
-            ast.block = []
-            
+
         # 如果一个Call块在我们之前，它把我们打印为"from"
-        if (self.index and isinstance(self.block[self.index - 1], renpy.ast.Call)):
+        if (self.index and isinstance(self.block[self.index - 1], _Call)):
             return
 
         # 看看我们是否是菜单的标签，而不是独立的标签。
@@ -363,7 +444,7 @@ class Decompiler(DecompilerBase):
             if remaining_blocks > 1:
                 # 标签后跟菜单
                 next_ast = self.block[self.index + 1]
-                if (isinstance(next_ast, renpy.ast.Menu)
+                if (isinstance(next_ast, _Menu)
                         and next_ast.linenumber == ast.linenumber):
                     self.label_inside_menu = ast
                     return
@@ -371,8 +452,8 @@ class Decompiler(DecompilerBase):
             if remaining_blocks > 2:
                 # 标签，后跟一个say，然后是菜单
                 next_next_ast = self.block[self.index + 2]
-                if (isinstance(next_ast, renpy.ast.Say)
-                        and isinstance(next_next_ast, renpy.ast.Menu)
+                if (isinstance(next_ast, _Say)
+                        and isinstance(next_next_ast, _Menu)
                         and next_next_ast.linenumber == ast.linenumber
                         and self.say_belongs_to_menu(next_ast, next_next_ast)):
 
@@ -386,12 +467,14 @@ class Decompiler(DecompilerBase):
         # 无法知道我们是否是，所以临时重定向我们的所有输出直到
         # 完成，这样如果我们是的话，我们可以挤入一个"init "
         out_file = self.out_file
-        self.out_file = StringIO()
+        self.out_file = ListWriter()
         missing_init = self.missing_init
         self.missing_init = False
         try:
-            self.write(f'label {ast.name}{reconstruct_paraminfo(ast.parameters)}'
-                       f'{" hide" if getattr(ast, "hide", False) else ""}:')
+            # 大多数标签没有参数，此时不必进入reconstruct_paraminfo
+            params = "" if ast.parameters is None else reconstruct_paraminfo(ast.parameters)
+            self.write(f'label {ast.name}{params}'
+                       f'{" hide" if ast.__dict__.get("hide", False) else ""}:')
             self.print_nodes(ast.block, 1)
         finally:
             if self.missing_init:
@@ -402,20 +485,15 @@ class Decompiler(DecompilerBase):
 
     @dispatch(renpy.ast.Jump)
     def print_jump(self, ast):
-        # Apply defaults for Ren'Py 8.4.0 compatibility
-        if not hasattr(ast, 'target'):
-            ast.target = None
-        if not hasattr(ast, 'expression'):
-            ast.expression = False
-            
+        _normalizers[type(ast)](ast)
+
         self.indent()
         self.write(f'jump {"expression " if ast.expression else ""}{ast.target}')
 
     @dispatch(renpy.ast.Call)
     def print_call(self, ast):
         self.indent()
-        words = WordConcatenator(False)
-        words.append("call")
+        words = ["call"]
         if ast.expression:
             words.append("expression")
         words.append(ast.label)
@@ -428,17 +506,15 @@ class Decompiler(DecompilerBase):
         # 我们不需要在这里检查是否有足够的元素，
         # 因为Label或Pass总是在Call之后发出。
         next_block = self.block[self.index + 1]
-        if isinstance(next_block, renpy.ast.Label):
+        if isinstance(next_block, _Label):
             words.append(f'from {next_block.name}')
 
-        self.write(words.join())
+        self.write(" ".join(words))
 
     @dispatch(renpy.ast.Return)
     def print_return(self, ast):
-        # Apply defaults for Ren'Py 8.4.0 compatibility
-        if not hasattr(ast, 'expression'):
-            ast.expression = None
-            
+        _normalizers[type(ast)](ast)
+
         if (ast.expression is None
                 and self.parent is None
                 and self.index + 1 == len(self.block)
@@ -460,7 +536,7 @@ class Decompiler(DecompilerBase):
         statement = First("if", "elif")
 
         # Apply defaults for Ren'Py 8.4.0 compatibility
-        entries = getattr(ast, 'entries', [])
+        entries = ast.__dict__.get('entries')
         if not entries:
         # 如果没有entries，跳过这个if语句
             return
@@ -468,7 +544,7 @@ class Decompiler(DecompilerBase):
         for i, (condition, block) in enumerate(entries):
             # Unicode字符串"True"用作else:的条件。
             # 但如果它是实际的表达式，它就是renpy.ast.PyExpr
-            if (i + 1) == len(entries) and not isinstance(condition, renpy.ast.PyExpr):
+            if (i + 1) == len(entries) and not isinstance(condition, _PyExpr):
                 self.indent()
                 self.write("else:")
             else:
@@ -490,12 +566,12 @@ class Decompiler(DecompilerBase):
 
     @dispatch(renpy.ast.Pass)
     def print_pass(self, ast):
-        if (self.index and isinstance(self.block[self.index - 1], renpy.ast.Call)):
+        if (self.index and isinstance(self.block[self.index - 1], _Call)):
             return
 
         if (self.index > 1
-                and isinstance(self.block[self.index - 2], renpy.ast.Call)
-                and isinstance(self.block[self.index - 1], renpy.ast.Label)
+                and isinstance(self.block[self.index - 2], _Call)
+                and isinstance(self.block[self.index - 1], _Label)
                 and self.block[self.index - 2].linenumber == ast.linenumber):
             return
 
@@ -504,47 +580,70 @@ class Decompiler(DecompilerBase):
         self.write("pass")
 
     def should_come_before(self, first, second):
-        return first.linenumber < second.linenumber
+        key = (id(first), id(second))
+        rv = self._scb_cache.get(key)
+        if rv is None:
+            rv = self._scb_cache[key] = first.linenumber < second.linenumber
+        return rv
 
     def require_init(self):
         if not self.in_init:
             self.missing_init = True
 
+    # 隐式init块中的语句类型到其默认优先级偏移的修正值
+    # Keep this table in sync with print_init
+    _init_offset_adjustments = {
+        renpy.ast.Screen: 500,
+        renpy.ast.Testcase: -500,
+        renpy.ast.Image: -500,
+    }
+
     def set_best_init_offset(self, nodes):
-        votes = {}
+        votes = Counter()
+        adjustments = self._init_offset_adjustments
+        should_come_before = self.should_come_before
         for ast in nodes:
-            if not isinstance(ast, renpy.ast.Init):
+            if not isinstance(ast, _Init):
                 continue
             offset = ast.priority
-            # Keep this block in sync with print_init
-            if len(ast.block) == 1 and not self.should_come_before(ast, ast.block[0]):
-                if isinstance(ast.block[0], renpy.ast.Screen):
-                    offset -= -500
-                elif isinstance(ast.block[0], renpy.ast.Testcase):
-                    offset -= 500
-                elif isinstance(ast.block[0], renpy.ast.Image):
-                    offset -= 500
-            votes[offset] = votes.get(offset, 0) + 1
+            block = ast.block
+            if len(block) == 1 and not should_come_before(ast, block[0]):
+                offset += adjustments.get(type(block[0]), 0)
+            votes[offset] += 1
         if votes:
-            winner = max(votes, key=votes.get)
+            winner, count = max(votes.items(), key=itemgetter(1))
             # 只有在可以节省超过一个优先级规范时才值得设置init偏移
-            if votes.get(0, 0) + 1 < votes[winner]:
+            if votes[0] + 1 < count:
                 self.set_init_offset(winner)
 
     def set_init_offset(self, offset):
-        def do_set_init_offset(linenumber):
+        def do_set_init_offset(linenumber, offset=offset, decompiler=self):
             # 如果我们到达文件末尾并且还没有发出这个，
             # 不要费心了，因为它只适用于下面的内容。
-            if linenumber is None or linenumber - self.linenumber <= 1 or self.indent_level:
+            if (linenumber is None or linenumber - decompiler.linenumber <= 1
+                    or decompiler.indent_level):
                 return True
-            if offset != self.init_offset:
-                self.indent()
-                self.write(f'init offset = {offset}')
-                self.init_offset = offset
+            if offset != decompiler.init_offset:
+                decompiler.indent()
+                decompiler.write(f'init offset = {offset}')
+                decompiler.init_offset = offset
             return False
 
         self.do_when_blank_line(do_set_init_offset)
 
+    # 可以拥有隐式init块的语句，映射到隐式init块的优先级（相对于init偏移），
+    # None表示任何优先级都可以。UserStatement只有layeredimage语句才适用
+    _implicit_init_priorities = {
+        renpy.ast.Define: None,
+        renpy.ast.Default: None,
+        renpy.ast.Transform: None,
+        renpy.ast.Screen: -500,
+        renpy.ast.Style: 0,
+        renpy.ast.Testcase: 500,
+        renpy.ast.UserStatement: 0,
+        renpy.ast.Image: 500,
+    }
+
     @dispatch(renpy.ast.Init)
     def print_init(self, ast):
         in_init = self.in_init
@@ -554,28 +653,27 @@ class Decompiler(DecompilerBase):
             # Define has a default priority of 0, screen of -500 and image of 990
             # 保持此块与set_best_init_offset同步
             # TODO merge this and require_init into another decorator or something
-            if (len(ast.block) == 1
-                    and (isinstance(ast.block[0], (renpy.ast.Define, renpy.ast.Default,
-                                                   renpy.ast.Transform))
-                         or (ast.priority == -500 + self.init_offset
-                             and isinstance(ast.block[0], renpy.ast.Screen))
-                         or (ast.priority == self.init_offset
-                             and isinstance(ast.block[0], renpy.ast.Style))
-                         or (ast.priority == 500 + self.init_offset
-                             and isinstance(ast.block[0], renpy.ast.Testcase))
-                         or (ast.priority == 0 + self.init_offset
-                             and isinstance(ast.block[0], renpy.ast.UserStatement)
-                             and ast.block[0].line.startswith("layeredimage "))
-                         or (ast.priority == 500 + self.init_offset
-                             and isinstance(ast.block[0], renpy.ast.Image)))
-                    and not (self.should_come_before(ast, ast.block[0]))):
+            implicit = False
+            if len(ast.block) == 1:
+                first = ast.block[0]
+                priorities = self._implicit_init_priorities
+                t = type(first)
+                if t in priorities:
+                    priority = priorities[t]
+                    implicit = ((priority is None
+                                 or ast.priority == priority + self.init_offset)
+                                and (not isinstance(first, _UserStatement)
+                                     or first.line.startswith("layeredimage "))
+                                and not self.should_come_before(ast, first))
+
+            if implicit:
                 # 如果它们满足这个条件，我们只是打印包含的语句
                 self.print_nodes(ast.block)
 
             # translatestring语句被分开并放入init块中。
             elif (len(ast.block) > 0
                   and ast.priority == self.init_offset
-                  and all(isinstance(i, renpy.ast.TranslateString) for i in ast.block)
+                  and all(isinstance(i, _TranslateString) for i in ast.block)
                   and all(i.language == ast.block[0].language for i in ast.block[1:])):
                 self.print_nodes(ast.block)
 
@@ -599,6 +697,17 @@ class Decompiler(DecompilerBase):
         self.print_say(self.say_inside_menu, inmenu=True)
         self.say_inside_menu = None
 
+    def say_inside_menu_cannot_fit(self, block):
+        # 在不知道菜单项行号时，检查是否可以不实际打印就确定say语句放不下。
+        # 打印say语句和菜单项标题至少各写一行，所以如果在块的第一个语句处
+        # 落后的行数已经超过了当前的last_lines_behind，print_menu中的回滚必然会发生
+        if not block or self.skip_indent_until_write:
+            return False
+        first = block[0]
+        if type(first) in self._skip_advance_types or not hasattr(first, 'linenumber'):
+            return False
+        return self.linenumber + 3 - first.linenumber > self.last_lines_behind
+
     def print_menu_item(self, label, condition, block, arguments):
         self.indent()
         self.write(f'"{string_escape(label)}"')
@@ -608,46 +717,51 @@ class Decompiler(DecompilerBase):
 
         if block is not None:
             # ren'py uses the unicode string "True" as condition when there isn't one.
-            if isinstance(condition, renpy.ast.PyExpr):
+            if isinstance(condition, _PyExpr):
                 self.write(f' if {condition}')
             self.write(":")
             self.print_nodes(block, 1)
 
     @dispatch(renpy.ast.Menu)
     def print_menu(self, ast):
-        self.indent()
-        self.write("menu")
+        get = ast.__dict__.get
+        write = self.write
+        indent = self.indent
+
+        indent()
+        write("menu")
         if self.label_inside_menu is not None:
-            self.write(f' {self.label_inside_menu.name}')
+            write(f' {self.label_inside_menu.name}')
             self.label_inside_menu = None
 
         # arguments attribute added in 7.1.4
-        if getattr(ast, "arguments", None) is not None:
-            self.write(reconstruct_arginfo(ast.arguments))
+        menu_arguments = get("arguments")
+        if menu_arguments is not None:
+            write(reconstruct_arginfo(menu_arguments))
 
-        self.write(":")
+        write(":")
 
         with self.increase_indent():
             # Apply defaults for Ren'Py 8.4.0 compatibility
-            with_ = getattr(ast, 'with_', None)
+            with_ = get('with_')
             if with_ is not None:
-                self.indent()
-                self.write(f'with {with_}')
+                indent()
+                write(f'with {with_}')
 
-            set_ = getattr(ast, 'set', None)
+            set_ = get('set')
             if set_ is not None:
-                self.indent()
-                self.write(f'set {set_}')
+                indent()
+                write(f'set {set_}')
 
             # item_arguments attribute since 7.1.4
-            if hasattr(ast, 'item_arguments'):
-                item_arguments = ast.item_arguments
-            else:
+            item_arguments = get('item_arguments')
+            if item_arguments is None:
                 item_arguments = [None] * len(ast.items)
 
+            translator = self.options.translator
             for (label, condition, block), arguments in zip(ast.items, item_arguments):
-                if self.options.translator:
-                    label = self.options.translator.strings.get(label, label)
+                if translator:
+                    label = translator.strings.get(label, label)
 
                 state = None
 
@@ -665,7 +779,8 @@ class Decompiler(DecompilerBase):
                         # there's not
                         self.print_say_inside_menu()
                     self.advance_to_line(condition.linenumber)
-                elif self.say_inside_menu is not None:
+                elif (self.say_inside_menu is not None
+                        and not self.say_inside_menu_cannot_fit(block)):
                     # The hard case: we don't know the line number that the menu item is on
                     # 所以尝试把它放入，但如果这让我们在
                     # 行号上落后，准备撤销它
@@ -676,16 +791,15 @@ class Decompiler(DecompilerBase):
                 self.print_menu_item(label, condition, block, arguments)
 
                 if state is not None:
-                    # state[7]是self.last_lines_behind的保存值
-                    if self.most_lines_behind > state[7]:
+                    if self.most_lines_behind > state.last_lines_behind:
                         # 我们试图打印菜单内的say语句，但它
                         # 不适合这里
                         # 撤销它并在没有它的情况下再次打印这个项目。我们稍后会把它放入
                         self.rollback_state(state)
                         self.print_menu_item(label, condition, block, arguments)
                     else:
-                        # state[6]是self.most_lines_behind的保存值
-                        self.most_lines_behind = max(state[6], self.most_lines_behind)
+                        self.most_lines_behind = max(state.most_lines_behind,
+                                                     self.most_lines_behind)
                         self.commit_state(state)
 
             if self.say_inside_menu is not None:
@@ -708,14 +822,15 @@ class Decompiler(DecompilerBase):
             if ast.hide:
                 self.write(" hide")
             # store attribute added in 6.14
-            if getattr(ast, "store", "store") != "store":
+            store = ast.__dict__.get("store", "store")
+            if store != "store":
                 self.write(" in ")
-        # 去除前置的"store."
-                self.write(ast.store[6:])
+                # 去除前置的"store."
+                self.write(store[6:])
             self.write(":")
 
             with self.increase_indent():
-                self.write_lines(split_logical_lines(code))
+                self.write_lines(iter_logical_lines(code))
 
         else:
             self.write(f'$ {code}')
@@ -732,28 +847,30 @@ class Decompiler(DecompilerBase):
         # If we have an implicit init block with a non-default priority, we need to store
         # the priority here.
         priority = ""
-        if isinstance(self.parent, renpy.ast.Init):
+        if isinstance(self.parent, _Init):
             init = self.parent
             if (init.priority != self.init_offset
                     and len(init.block) == 1
                     and not self.should_come_before(init, ast)):
                 priority = f' {init.priority - self.init_offset}'
 
+        get = ast.__dict__.get
+
         index = ""
         # index属性在7.4中添加
-        if getattr(ast, "index", None) is not None:
+        if get("index") is not None:
             index = f'[{ast.index.source}]'
 
         # operator属性在7.4中添加
-        operator = getattr(ast, "operator", "=")
+        operator = get("operator", "=")
 
         # store属性在6.18.2中添加
-        if getattr(ast, "store", "store") == "store":
-            self.write(f'define{priority} {ast.varname}{index} {operator} {ast.code.source}')
-        else:
-            self.write(
-                f'define{priority} {ast.store[6:]}.{ast.varname}{index} {operator} '
-                f'{ast.code.source}')
+        store = get("store", "store")
+        parts = ["define", priority, " "]
+        if store != "store":
+            parts += (store[6:], ".")
+        parts += (ast.varname, index, " ", operator, " ", ast.code.source)
+        self.write("".join(parts))
 
     @dispatch(renpy.ast.Default)
     def print_default(self, ast):
@@ -761,30 +878,38 @@ class Decompiler(DecompilerBase):
         self.indent()
 
         # Apply defaults for Ren'Py 8.4.0 compatibility
-        store = getattr(ast, 'store', 'store')
+        store = ast.__dict__.get('store', 'store')
         if store is None:
             store = 'store'
 
         # If we have an implicit init block with a non-default priority, we need to store the
         # priority here.
         priority = ""
-        if isinstance(self.parent, renpy.ast.Init):
+        if isinstance(self.parent, _Init):
             init = self.parent
             if (init.priority != self.init_offset
                     and len(init.block) == 1
                     and not self.should_come_before(init, ast)):
                 priority = f' {init.priority - self.init_offset}'
 
-        if store == "store":
-            self.write(f'default{priority} {ast.varname} = {ast.code.source}')
-        else:
-            self.write(f'default{priority} {store[6:]}.{ast.varname} = {ast.code.source}')
+        parts = ["default", priority, " "]
+        if store != "store":
+            parts += (store[6:], ".")
+        parts += (ast.varname, " = ", ast.code.source)
+        self.write("".join(parts))
 
     # 特殊功能
 
     # 返回紧接在菜单语句之前的Say语句
     # 是否实际属于菜单语句内部。
     def say_belongs_to_menu(self, say, menu):
+        key = (id(say), id(menu))
+        rv = self._sbtm_cache.get(key)
+        if rv is None:
+            rv = self._sbtm_cache[key] = self._say_belongs_to_menu(say, menu)
+        return rv
+
+    def _say_belongs_to_menu(self, say, menu):
         # Apply defaults for Ren'Py 8.4.0 compatibility
         interact = getattr(say, 'interact', True)
         who = getattr(say, 'who', None)
@@ -795,28 +920,14 @@ class Decompiler(DecompilerBase):
                 and who is not None
                 and with_ is None
                 and attributes is None
-                and isinstance(menu, renpy.ast.Menu)
+                and isinstance(menu, _Menu)
                 and menu.items[0][2] is not None
                 and not self.should_come_before(say, menu))
 
     @dispatch(renpy.ast.Say)
     def print_say(self, ast, inmenu=False):
-        # Apply defaults for Ren'Py 8.4.0 compatibility
-        if not hasattr(ast, 'who'):
-            ast.who = None
-        if not hasattr(ast, 'what'):
-            ast.what = None
-        if not hasattr(ast, 'with_'):
-            ast.with_ = None
-        if not hasattr(ast, 'interact'):
-            ast.interact = True
-        if not hasattr(ast, 'attributes'):
-            ast.attributes = None
-        if not hasattr(ast, 'temporary_attributes'):
-            ast.temporary_attributes = None
-        if not hasattr(ast, 'rollback'):
-            ast.rollback = None
-            
+        _normalizers[type(ast)](ast)
+
         # 如果这个say语句位于菜单语句之前，推迟发出它直到我们
         # 处理菜单
         if (not inmenu
@@ -835,66 +946,100 @@ class Decompiler(DecompilerBase):
         self.write(ast.line)
 
         # block属性自6.13.0以来
-        if getattr(ast, "block", None):
+        if ast.__dict__.get("block"):
             with self.increase_indent():
                 self.print_lex(ast.block)
 
     def print_lex(self, lex):
-        for file, linenumber, content, block in lex:
-            self.advance_to_line(linenumber)
-            self.indent()
-            self.write(content)
-            if block:
-                with self.increase_indent():
-                    self.print_lex(block)
+        # 用显式的栈代替递归遍历嵌套的块
+        stack = [iter(lex)]
+        base_indent = self.indent_level
+        try:
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                    if stack:
+                        self.indent_level -= 1
+                    continue
+
+                file, linenumber, content, block = entry
+                self.advance_to_line(linenumber)
+                self.indent()
+                self.write(content)
+                if block:
+                    self.indent_level += 1
+                    stack.append(iter(block))
+        finally:
+            self.indent_level = base_indent
 
     @dispatch(renpy.ast.Style)
     def print_style(self, ast):
         self.require_init()
-        keywords = {ast.linenumber: WordConcatenator(False, True)}
+        first_line = WordConcatenator(False, True)
+        keywords = {ast.linenumber: first_line}
 
         # Apply defaults for Ren'Py 8.4.0 compatibility
-        parent = getattr(ast, 'parent', None)
-        clear = getattr(ast, 'clear', False)
-        take = getattr(ast, 'take', None)
-        delattr = getattr(ast, 'delattr', [])
+        get = ast.__dict__.get
+        parent = get('parent')
+        clear = get('clear', False)
+        take = get('take')
+        delattr = get('delattr', ())
 
         # 这些不存储行号，所以只是把它们放在第一行
         if parent is not None:
-            keywords[ast.linenumber].append(f'is {parent}')
+            first_line.append(f'is {parent}')
         if clear:
-            keywords[ast.linenumber].append("clear")
+            first_line.append("clear")
         if take is not None:
-            keywords[ast.linenumber].append(f'take {take}')
+            first_line.append(f'take {take}')
         for delname in delattr:
-            keywords[ast.linenumber].append(f'del {delname}')
+            first_line.append(f'del {delname}')
 
         # 这些确实存储行号
-        variant = getattr(ast, 'variant', None)
-        properties = getattr(ast, 'properties', {})
-        
+        variant = get('variant')
+        properties = get('properties', {})
+
+        linenumber = ast.linenumber
         if variant is not None:
-            if variant.linenumber not in keywords:
-                keywords[variant.linenumber] = WordConcatenator(False)
-            keywords[variant.linenumber].append(f'variant {variant}')
+            if variant.linenumber == linenumber:
+                first_line.append(f'variant {variant}')
+            else:
+                if variant.linenumber not in keywords:
+                    keywords[variant.linenumber] = WordConcatenator(False)
+                keywords[variant.linenumber].append(f'variant {variant}')
         for key, value in properties.items():
-            if value.linenumber not in keywords:
-                keywords[value.linenumber] = WordConcatenator(False)
-            keywords[value.linenumber].append(f'{key} {value}')
+            if value.linenumber == linenumber:
+                first_line.append(f'{key} {value}')
+            else:
+                if value.linenumber not in keywords:
+                    keywords[value.linenumber] = WordConcatenator(False)
+                keywords[value.linenumber].append(f'{key} {value}')
 
-        keywords = sorted([(k, v.join()) for k, v in keywords.items()],
-                          key=itemgetter(0))
         self.indent()
-        self.write(f'style {ast.style_name}')
-        if keywords[0][1]:
-            self.write(f' {keywords[0][1]}')
+        if len(keywords) == 1:
+            # 常见情况：所有内容都在style语句所在的那一行
+            first = first_line.join()
+            if first:
+                self.write(f'style {ast.style_name} {first}')
+            else:
+                self.write(f'style {ast.style_name}')
+            return
+
+        # 行号是唯一的，所以排序不会比较到WordConcatenator
+        keywords = sorted(keywords.items())
+        first = keywords[0][1].join()
+        if first:
+            self.write(f'style {ast.style_name} {first}')
+        else:
+            self.write(f'style {ast.style_name}')
         if len(keywords) > 1:
             self.write(":")
             with self.increase_indent():
-                for i in keywords[1:]:
-                    self.advance_to_line(i[0])
+                for linenumber, words in keywords[1:]:
+                    self.advance_to_line(linenumber)
                     self.indent()
-                    self.write(i[1])
+                    self.write(words.join())
 
     # 翻译函数
 
@@ -915,7 +1060,7 @@ class Decompiler(DecompilerBase):
         self.require_init()
         # 最后一个节点是translatestrings节点吗？
         if not (self.index
-                and isinstance(self.block[self.index - 1], renpy.ast.TranslateString)
+                and isinstance(self.block[self.index - 1], _TranslateString)
                 and self.block[self.index - 1].language == ast.language):
             self.indent()
             self.write(f'translate {ast.language or "None"} strings:')
@@ -942,7 +1087,7 @@ class Decompiler(DecompilerBase):
 
         in_init = self.in_init
         if (len(ast.block) == 1
-                and isinstance(ast.block[0], (renpy.ast.Python, renpy.ast.Style))):
+                and isinstance(ast.block[0], (_Python, _Style))):
             # Ren'Py将"translate python"和"translate style"的TranslateBlock
             # 计算为Init。
             self.in_init = True
@@ -19,14 +19,29 @@
 # SOFTWARE.
 
 import sys
-import inspect
+import types
 import renpy
 
+# inspect.isroutine()返回True的对象类型
+ROUTINE_TYPES = (types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+                 types.MethodWrapperType, types.WrapperDescriptorType,
+                 types.MethodDescriptorType, types.ClassMethodDescriptorType)
+
 def pprint(out_file, ast, comparable=False, no_pyexpr=False):
     # 此模块的主要函数，一个包装器，用于设置
     # 配置并创建AstDumper实例
     AstDumper(out_file, comparable=comparable, no_pyexpr=no_pyexpr).dump(ast)
 
+def class_name(cls):
+    # 与repr(cls)中引号内的名称相同，但不需要先构建repr再切片
+    module = cls.__module__
+    if module == 'builtins' or not isinstance(module, str):
+        return cls.__qualname__
+    return f'{module}.{cls.__qualname__}'
+
+# 每次访问renpy.ast.PyExpr都要经过FakePackage.__getattr__，在这里解析一次
+PyExpr = renpy.ast.PyExpr
+
 class AstDumper(object):
     """
     一个处理python对象树遍历的对象
@@ -43,28 +58,57 @@ class AstDumper(object):
         self.comparable = comparable
         self.no_pyexpr = no_pyexpr
 
+        # 常见内置类型的精确类型到打印方法的映射。其他类型（包括这些类型的子类，
+        # 比如PyExpr和Revertable*容器）走print_ast中的isinstance检查
+        self.printers = {
+            list: self.print_list,
+            tuple: self.print_list,
+            set: self.print_list,
+            frozenset: self.print_list,
+            dict: self.print_dict,
+            str: self.print_string,
+            bytes: self.print_bytes,
+            bytearray: self.print_bytes,
+            int: self.print_other,
+            bool: self.print_other,
+            type(None): self.print_other,
+        }
+        # 每个类中可能需要打印的类属性名，见candidate_keys
+        self.class_keys = {}
+        # 每种实例属性布局的排序属性名，见candidate_keys
+        self.layout_keys = {}
+
     def dump(self, ast):
         self.linenumber = 1
         self.indent = 0
-        # 我们将在这里保留一个已遍历对象的栈，这样我们就不会在循环引用上无限递归
-        self.passed = []
-        self.passed_where = []
-        self.print_ast(ast)
+        # 换行加上当前缩进，缩进级别改变时在ind()中更新
+        self.indent_str = '\n'
+        # 我们将在这里记录正在遍历的对象的id()及其所在行，这样我们就不会在循环引用上
+        # 无限递归。栈上的对象在遍历期间一直存活，所以它们的id()不会被复用
+        self.passed = {}
+        # 输出先收集在这里，结束时一次写入文件
+        self.buffer = []
+        try:
+            self.print_ast(ast)
+        finally:
+            self.out_file.write(''.join(self.buffer))
+            self.buffer = []
 
     def print_ast(self, ast):
         # 决定应该使用哪个函数来打印给定的ast对象。
-        try:
-            i = self.passed.index(ast)
-        except ValueError:
-            pass
-        else:
-            self.p(f'<circular reference to object on line {self.passed_where[i]}>')
+        passed = self.passed
+        key = id(ast)
+        where = passed.get(key)
+        if where is not None:
+            self.p(f'<circular reference to object on line {where}>')
             return
-        self.passed.append(ast)
-        self.passed_where.append(self.linenumber)
-        if isinstance(ast, (list, tuple, set, frozenset)):
+        passed[key] = self.linenumber
+        printer = self.printers.get(type(ast))
+        if printer is not None:
+            printer(ast)
+        elif isinstance(ast, (list, tuple, set, frozenset)):
             self.print_list(ast)
-        elif isinstance(ast, renpy.ast.PyExpr):
+        elif isinstance(ast, PyExpr):
             self.print_pyexpr(ast)
         elif isinstance(ast, dict):
             self.print_dict(ast)
@@ -74,35 +118,40 @@ class AstDumper(object):
             self.print_bytes(ast)
         elif isinstance(ast, (int, bool)) or ast is None:
             self.print_other(ast)
-        elif inspect.isclass(ast):
+        elif isinstance(ast, type):
             self.print_class(ast)
         elif isinstance(ast, object):
             self.print_object(ast)
         else:
             self.print_other(ast)
-        self.passed_where.pop()
-        self.passed.pop()
+        del passed[key]
 
     def print_list(self, ast):
         # handles the printing of simple containers of N elements.
-        if type(ast) not in (list, tuple, set, frozenset):
-            self.p(repr(type(ast)))
+        klass = type(ast)
+        if klass not in self.MAP_OPEN:
+            self.p(repr(klass))
 
-            for k in (list, tuple, set, frozenset):
-                if isinstance(ast, k):
-                    klass = k
-
-        else:
-            klass = ast.__class__
+            if isinstance(ast, list):
+                klass = list
+            elif isinstance(ast, tuple):
+                klass = tuple
+            elif isinstance(ast, set):
+                klass = set
+            else:
+                klass = frozenset
 
         self.p(self.MAP_OPEN[klass])
 
         self.ind(1, ast)
+        # 元素之间的分隔符：逗号、换行和当前缩进。直接放入缓冲区而不是调用p()和ind()
+        sep = ',' + self.indent_str
+        last = len(ast) - 1
         for i, obj in enumerate(ast):
             self.print_ast(obj)
-            if i+1 != len(ast):
-                self.p(',')
-                self.ind()
+            if i != last:
+                self.buffer.append(sep)
+                self.linenumber += 1
         self.ind(-1, ast)
         self.p(self.MAP_CLOSE[klass])
 
@@ -114,18 +163,48 @@ class AstDumper(object):
         self.p('{')
 
         self.ind(1, ast)
-        for i, key in enumerate(ast):
+        sep = ',' + self.indent_str
+        last = len(ast) - 1
+        for i, (key, value) in enumerate(ast.items()):
             self.print_ast(key)
             self.p(': ')
-            self.print_ast(ast[key])
-            if i+1 != len(ast):
-                self.p(',')
-                self.ind()
+            self.print_ast(value)
+            if i != last:
+                self.buffer.append(sep)
+                self.linenumber += 1
         self.ind(-1, ast)
         self.p('}')
 
+    def candidate_keys(self, ast):
+        # 返回与dir(ast)相同顺序的可能需要打印的属性名。类的dir()对同一个类的所有实例
+        # 都一样，所以只计算一次，并预先去掉以_开头的名称和方法。实例自己的属性
+        # 总是包含在内，剩下的判断由should_print_key完成
+        cls = type(ast)
+        class_keys = self.class_keys.get(cls)
+        if class_keys is None:
+            class_keys = frozenset(
+                key for key in dir(cls)
+                if not key.startswith('_') and not isinstance(getattr(cls, key, None), ROUTINE_TYPES))
+            self.class_keys[cls] = class_keys
+
+        instance_keys = getattr(ast, '__dict__', None)
+        if not instance_keys:
+            return sorted(class_keys)
+
+        # 同一个类的实例通常有相同的属性集，所以按(类, 实例属性名)缓存排序结果。
+        # 用id()作为类的键以避免伪类的__hash__；被转储的树在整个转储期间存活，
+        # 所以它的类也是
+        layout = (id(cls), tuple(instance_keys))
+        keys = self.layout_keys.get(layout)
+        if keys is None:
+            keys = tuple(sorted(class_keys.union(
+                key for key in instance_keys if not key.startswith('_'))))
+            self.layout_keys[layout] = keys
+        return keys
+
     def should_print_key(self, ast, key):
-        if key.startswith('_') or not hasattr(ast, key) or inspect.isroutine(getattr(ast, key)):
+        if (key.startswith('_') or not hasattr(ast, key)
+                or isinstance(getattr(ast, key), ROUTINE_TYPES)):
             return False
         elif not self.comparable:
             return True
@@ -210,20 +289,20 @@ class AstDumper(object):
         # prints the values of relevant attributes in a dictionary-like way
         # it will not print anything which is a bound method or starts with a _
         self.p('<')
-        self.p(str(ast.__class__)[8:-2] if hasattr(ast, '__class__') else str(ast))
+        self.p(class_name(type(ast)))
 
-        keys = list(i for i in dir(ast) if self.should_print_key(ast, i))
+        keys = list(i for i in self.candidate_keys(ast) if self.should_print_key(ast, i))
         if keys:
             self.p(' ')
         self.ind(1, keys)
+        sep = ',' + self.indent_str
+        last = len(keys) - 1
         for i, key in enumerate(keys):
-            self.p('.')
-            self.p(str(key))
-            self.p(' = ')
+            self.p(f'.{key} = ')
             self.print_ast(getattr(ast, key))
-            if i+1 != len(keys):
-                self.p(',')
-                self.ind()
+            if i != last:
+                self.buffer.append(sep)
+                self.linenumber += 1
         self.ind(-1, keys)
         self.p('>')
 
@@ -236,47 +315,47 @@ class AstDumper(object):
     def print_class(self, ast):
         # handles the printing of classes
         self.p('<class ')
-        self.p(str(ast)[8:-2])
+        self.p(class_name(ast))
         self.p('>')
 
     def print_string(self, ast):
         # prints the representation of a string. If there are newlines in this string,
         # it will print it as a docstring.
-        if '\n' in ast:
-            astlist = ast.split('\n')
-            self.p('"""')
-            self.p(self.escape_string(astlist.pop(0)))
-            for i, item in enumerate(astlist):
-                self.p('\n')
-                self.p(self.escape_string(item))
-            self.p('"""')
-            self.ind()
+        if '\n' not in ast:
+            # 常见情况。repr()中不会有换行符，所以可以直接放入缓冲区
+            self.buffer.append(repr(ast))
+            return
 
-        else:
-            self.p(repr(ast))
+        astlist = ast.split('\n')
+        self.p('"""')
+        self.p(self.escape_string(astlist.pop(0)))
+        for i, item in enumerate(astlist):
+            self.p('\n')
+            self.p(self.escape_string(item))
+        self.p('"""')
+        self.ind()
 
     def print_bytes(self, ast):
         # prints the representation of a bytes object. If there are newlines in this string,
         # it will print it as a docstring.
-        is_bytearray = isinstance(ast, bytearray)
-
-        if b'\n' in ast:
-            astlist = ast.split(b'\n')
-            if is_bytearray:
-                self.p('bytearray(')
-            self.p('b')
-            self.p('"""')
-            self.p(self.escape_string(astlist.pop(0)))
-            for i, item in enumerate(astlist):
-                self.p('\n')
-                self.p(self.escape_string(item))
-            self.p('"""')
-            if is_bytearray:
-                self.p(')')
-            self.ind()
+        if b'\n' not in ast:
+            self.buffer.append(repr(ast))
+            return
 
-        else:
-            self.p(repr(ast))
+        is_bytearray = isinstance(ast, bytearray)
+        astlist = ast.split(b'\n')
+        if is_bytearray:
+            self.p('bytearray(')
+        self.p('b')
+        self.p('"""')
+        self.p(self.escape_string(astlist.pop(0)))
+        for i, item in enumerate(astlist):
+            self.p('\n')
+            self.p(self.escape_string(item))
+        self.p('"""')
+        if is_bytearray:
+            self.p(')')
+        self.ind()
 
     def escape_string(self, string):
         # essentially the representation of a string without the surrounding quotes
@@ -298,11 +377,16 @@ class AstDumper(object):
         # compared to the last line. it will chech the length of ast to determine if it
         # shouldn't indent in case there's only one or zero objects in this object to print
         if ast is None or len(ast) > 1:
-            self.indent += diff_indent
-            self.p('\n' + self.indentation * self.indent)
+            if diff_indent:
+                self.indent += diff_indent
+                self.indent_str = '\n' + self.indentation * self.indent
+            self.buffer.append(self.indent_str)
+            self.linenumber += 1
 
     def p(self, string):
         # write the string to the stream
-        string = str(string)
-        self.linenumber += string.count('\n')
-        self.out_file.write(string)
+        if type(string) is not str:
+            string = str(string)
+        if '\n' in string:
+            self.linenumber += string.count('\n')
+        self.buffer.append(string)
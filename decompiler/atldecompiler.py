@@ -58,7 +58,13 @@ class ATLDecompiler(DecompilerBase):
             else:
                 self.advance_to_line(ast.loc[1])
 
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        # A new instance is made for every block, so binding the table per instance like
+        # Decompiler does wouldn't pay off. Unknown nodes are rare, so skip .get() instead.
+        try:
+            method = self.dispatch[type(ast)]
+        except KeyError:
+            method = type(self).print_unknown
+        method(self, ast)
 
     def print_block(self, block):
         # Prints a block of ATL statements
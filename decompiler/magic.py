@@ -243,7 +243,8 @@ class FakeClassFactory(object):
         self.special_cases = dict(((i.__module__, i.__name__), i) for i in special_cases)
         self.default = default_class
 
-        self.class_cache = {}
+        # The special cases are seeded into the cache, so any lookup is a single dict hit.
+        self.class_cache = dict(self.special_cases)
 
     def __call__(self, name, module):
         """
@@ -254,18 +255,11 @@ class FakeClassFactory(object):
 
         Created class definitions are cached per factory instance.
         """
-        # Check if we've got this class cached
-        klass = self.class_cache.get((module, name), None)
-        if klass is not None:
-            return klass
-
-        klass = self.special_cases.get((module, name), None)
-
-        if not klass:
+        key = (module, name)
+        klass = self.class_cache.get(key)
+        if klass is None:
             # generate a new class def which inherits from the default fake class
-            klass = type(name, (self.default,), {"__module__": module})
-
-        self.class_cache[(module, name)] = klass
+            klass = self.class_cache[key] = type(name, (self.default,), {"__module__": module})
         return klass
 
 # Fake module implementation
@@ -533,8 +527,9 @@ class SafeUnpickler(FakeUnpickler):
     def __init__(self, file, class_factory=None, safe_modules=(),
                  use_copyreg=False, encoding="bytes", errors="strict"):
         FakeUnpickler.__init__(self, file, class_factory, encoding=encoding, errors=errors)
-        # A set of modules which are safe to load
-        self.safe_modules = set(safe_modules)
+        # A set of modules which are safe to load. A frozenset can be shared as is.
+        self.safe_modules = (safe_modules if isinstance(safe_modules, frozenset)
+                             else frozenset(safe_modules))
         self.use_copyreg = use_copyreg
 
     def find_class(self, module, name):
@@ -26,13 +26,28 @@ from . import magic
 magic.fake_package("renpy")
 import renpy  # noqa
 
-import pickletools
+import pickle
+import re
+import struct
+from functools import partial
 
 
 # 这些命名类需要一些特殊处理，以便我们能够从pickle重建ren'py AST
 SPECIAL_CLASSES = [set, frozenset]
 
 
+def special_class(cls):
+    # 注册cls并返回它，这样类名在模块中仍然绑定到该类
+    SPECIAL_CLASSES.append(cls)
+    return cls
+
+
+def relocated(cls, module):
+    # 返回特殊类cls的副本，它假装位于module中。用于在不同ren'py版本中换了位置的类
+    namespace = {k: v for k, v in cls.__dict__.items() if k not in ("__dict__", "__weakref__")}
+    return magic.FakeClassType(cls.__name__, cls.__bases__, namespace, module)
+
+
 # ren'py _令人烦恼地_即使在ren'py v8中仍然启用fix_imports，并且仍然默认使用pickle协议2。
 # 所以set/frozenset被映射到错误的位置（__builtins__而不是builtins）
 # 我们不想启用该选项，因为我们想控制pickler允许unpickle什么
@@ -41,8 +56,8 @@ class oldset(set):
     __module__ = "__builtin__"
 
     def __reduce__(self):
-        cls, args, state = super().__reduce__()
-        return (set, args, state)
+        # Same as set.__reduce__, but pickled as the real set
+        return (set, (list(self),), self.__dict__ or None)
 
 
 oldset.__name__ = "set"
@@ -53,15 +68,15 @@ class oldfrozenset(frozenset):
     __module__ = "__builtin__"
 
     def __reduce__(self):
-        cls, args, state = super().__reduce__()
-        return (frozenset, args, state)
+        # Same as frozenset.__reduce__, but pickled as the real frozenset
+        return (frozenset, (list(self),), self.__dict__ or None)
 
 
 oldfrozenset.__name__ = "frozenset"
 SPECIAL_CLASSES.append(oldfrozenset)
 
 
-@SPECIAL_CLASSES.append
+@special_class
 class PyExpr(magic.FakeStrict, str):
     __module__ = "renpy.astsupport"
 
@@ -74,27 +89,38 @@ class PyExpr(magic.FakeStrict, str):
         return self
 
     def __getnewargs__(self):
-        if self.py is not None and self.hash is not None:
-            return str(self), self.filename, self.linenumber, self.py, self.hash
-        elif self.py is not None:
-            return str(self), self.filename, self.linenumber, self.py
-        else:
-            return str(self), self.filename, self.linenumber
+        # str.__str__ gives the plain str value without going through str()'s lookup
+        args = (str.__str__(self), self.filename, self.linenumber)
+        if self.py is None:
+            return args
+        if self.hash is None:
+            return args + (self.py,)
+        return args + (self.py, self.hash)
 
 
-@SPECIAL_CLASSES.append
+@special_class
 class PyCode(magic.FakeStrict):
     __module__ = "renpy.astsupport"
 
+    # The fields stored after the first (unused) item of each known state layout.
+    # Ren'Py 8.4.0 added the hash.
+    _state_fields = {
+        4: ("source", "location", "mode"),
+        5: ("source", "location", "mode", "py"),
+        6: ("source", "location", "mode", "py", "hash"),
+    }
+
     def __setstate__(self, state):
-        if len(state) == 4:
-            (_, self.source, self.location, self.mode) = state
+        # unrpyc's own SafePickler (used by the AST cache and translation data) stores the
+        # instance __dict__ instead of ren'py's tuple layout.
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+            return
+
+        fields = self._state_fields.get(len(state))
+        if fields is not None:
             self.py = None
-        elif len(state) == 5:
-            (_, self.source, self.location, self.mode, self.py) = state
-        elif len(state) == 6:
-            # Ren'Py 8.4.0 format with hash
-            (_, self.source, self.location, self.mode, self.py, self.hash) = state
+            self.__dict__.update(zip(fields, state[1:]))
         else:
             # Fallback for any other number of parameters
             self.source = state[1] if len(state) > 1 else None
@@ -106,7 +132,7 @@ class PyCode(magic.FakeStrict):
 
 
 # Keep compatibility with older Ren'Py versions
-@SPECIAL_CLASSES.append
+@special_class
 class PyExpr(magic.FakeStrict, str):
     __module__ = "renpy.ast"
 
@@ -118,36 +144,14 @@ class PyExpr(magic.FakeStrict, str):
         return self
 
     def __getnewargs__(self):
-        if self.py is not None:
-            return str(self), self.filename, self.linenumber, self.py
-        else:
-            return str(self), self.filename, self.linenumber
+        args = (str.__str__(self), self.filename, self.linenumber)
+        return args if self.py is None else args + (self.py,)
 
 
-@SPECIAL_CLASSES.append
-class PyCode(magic.FakeStrict):
-    __module__ = "renpy.ast"
-
-    def __setstate__(self, state):
-        if len(state) == 4:
-            (_, self.source, self.location, self.mode) = state
-            self.py = None
-        elif len(state) == 5:
-            (_, self.source, self.location, self.mode, self.py) = state
-        elif len(state) == 6:
-            # Ren'Py 8.4.0 format with hash
-            (_, self.source, self.location, self.mode, self.py, self.hash) = state
-        else:
-            # Fallback for any other number of parameters
-            self.source = state[1] if len(state) > 1 else None
-            self.location = state[2] if len(state) > 2 else None
-            self.mode = state[3] if len(state) > 3 else None
-            self.py = state[4] if len(state) > 4 else None
-            self.hash = state[5] if len(state) > 5 else None
-        self.bytecode = None
+SPECIAL_CLASSES.append(relocated(PyCode, "renpy.ast"))
 
 
-@SPECIAL_CLASSES.append
+@special_class
 class Sentinel(magic.FakeStrict):
     __module__ = "renpy.object"
 
@@ -158,7 +162,7 @@ class Sentinel(magic.FakeStrict):
 
 
 # These appear in the parsed contents of user statements.
-@SPECIAL_CLASSES.append
+@special_class
 class RevertableList(magic.FakeStrict, list):
     __module__ = "renpy.revertable"
 
@@ -166,7 +170,7 @@ class RevertableList(magic.FakeStrict, list):
         return list.__new__(cls)
 
 
-@SPECIAL_CLASSES.append
+@special_class
 class RevertableDict(magic.FakeStrict, dict):
     __module__ = "renpy.revertable"
 
@@ -174,7 +178,7 @@ class RevertableDict(magic.FakeStrict, dict):
         return dict.__new__(cls)
 
 
-@SPECIAL_CLASSES.append
+@special_class
 class RevertableSet(magic.FakeStrict, set):
     __module__ = "renpy.revertable"
 
@@ -182,61 +186,99 @@ class RevertableSet(magic.FakeStrict, set):
         return set.__new__(cls)
 
     def __setstate__(self, state):
-        if isinstance(state, tuple):
+        # The unpickler only ever produces exact tuples. An optimistic state[0] can't be
+        # used instead, as a list state could hold a dict as its first item.
+        if type(state) is tuple:
             self.update(state[0].keys())
         else:
             self.update(state)
 
 # Before ren'py 7.5/8.0 they lived in renpy.python, so for compatibility we keep it here.
-@SPECIAL_CLASSES.append
-class RevertableList(magic.FakeStrict, list):
-    __module__ = "renpy.python"
+SPECIAL_CLASSES.append(relocated(RevertableList, "renpy.python"))
+SPECIAL_CLASSES.append(relocated(RevertableDict, "renpy.python"))
+SPECIAL_CLASSES.append(relocated(RevertableSet, "renpy.python"))
 
-    def __new__(cls):
-        return list.__new__(cls)
 
+CLASS_FACTORY = magic.FakeClassFactory(SPECIAL_CLASSES, magic.FakeStrict)
 
-@SPECIAL_CLASSES.append
-class RevertableDict(magic.FakeStrict, dict):
-    __module__ = "renpy.python"
 
-    def __new__(cls):
-        return dict.__new__(cls)
+# Modules pickle_safe_loads may import from for real.
+SAFE_MODULES = frozenset(("collections",))
 
+# The loaders always get the same arguments, so bind them once here.
+_safe_loads = partial(magic.safe_loads, class_factory=CLASS_FACTORY,
+                      safe_modules=SAFE_MODULES, encoding="ASCII",
+                      errors="strict")
+_loads = partial(magic.loads, class_factory=CLASS_FACTORY)
 
-@SPECIAL_CLASSES.append
-class RevertableSet(magic.FakeStrict, set):
-    __module__ = "renpy.python"
 
-    def __new__(cls):
-        return set.__new__(cls)
-
-    def __setstate__(self, state):
-        if isinstance(state, tuple):
-            self.update(state[0].keys())
-        else:
-            self.update(state)
-
-
-CLASS_FACTORY = magic.FakeClassFactory(SPECIAL_CLASSES, magic.FakeStrict)
+def pickle_optimize(buffer: bytes):
+    # Strips unused PUT opcodes. This is a pure python pass over the whole pickle, so it
+    # only pays off for buffers that get loaded or scanned more than once.
+    import pickletools
+    return pickletools.optimize(buffer)
 
 
 def pickle_safe_loads(buffer: bytes):
-    return magic.safe_loads(
-        buffer, CLASS_FACTORY, {"collections"}, encoding="ASCII", errors="strict")
+    return _safe_loads(buffer)
 
 
-def pickle_safe_dumps(buffer: bytes):
-    return magic.safe_dumps(buffer)
+# These pickles only travel between unrpyc's own processes, so they can use the highest
+# protocol (with framing). Pass protocol=2 for anything ren'py itself has to read back.
+def pickle_safe_dumps(buffer: bytes, protocol=pickle.HIGHEST_PROTOCOL):
+    return magic.safe_dumps(buffer, protocol)
 
 
 # if type hints: which one would be output file? bytesIO or bytes?
-def pickle_safe_dump(buffer: bytes, outfile):
-    return magic.safe_dump(buffer, outfile)
+def pickle_safe_dump(buffer: bytes, outfile, protocol=pickle.HIGHEST_PROTOCOL):
+    return magic.safe_dump(buffer, outfile, protocol)
 
 
 def pickle_loads(buffer: bytes):
-    return magic.loads(buffer, CLASS_FACTORY)
+    return _loads(buffer)
+
+
+# Opcodes pickle_detect_python2 looks at
+PICKLE_PROTO = 0x80
+PICKLE_STOP = ord(".")
+PICKLE_BINSTRING = ord("T")
+PICKLE_SHORT_BINSTRING = ord("U")
+
+# Any byte that could be an opcode pickle_detect_python2 decides on
+PICKLE_DECIDING_BYTES = re.compile(rb"[TU\x80]")
+
+# Argument encodings for every pickle opcode, mirroring the arguments pickletools documents.
+# Arguments are either a fixed number of bytes, run up to one (UP_TO_NEWLINE) or two
+# (NEWLINE_PAIR) newlines, or are prefixed by their length, which is stored in the
+# (struct format, prefix length) given in PICKLE_LENGTH_PREFIXES.
+UP_TO_NEWLINE = -1
+NEWLINE_PAIR = -2
+LENGTH_BYTE1 = -3
+LENGTH_INT4 = -4
+LENGTH_UINT4 = -5
+LENGTH_UINT8 = -6
+PICKLE_LENGTH_PREFIXES = {
+    LENGTH_BYTE1: ("<B", 1),
+    LENGTH_INT4: ("<i", 4),
+    LENGTH_UINT4: ("<I", 4),
+    LENGTH_UINT8: ("<Q", 8),
+}
+PICKLE_ARG_SIZES = {
+    code: size for size, codes in (
+        (0, b"N\x88\x89]aelt)\x85\x86\x87}dsu\x8f\x90\x91"
+            b"021(\x94\x93Rbo\x81\x92.Q\x97\x98"),
+        (1, b"Khq\x82\x80"),
+        (2, b"M\x83"),
+        (4, b"Jjr\x84"),
+        (8, b"G\x95"),
+        (UP_TO_NEWLINE, b"ILSVFgpP"),
+        (NEWLINE_PAIR, b"ci"),
+        (LENGTH_BYTE1, b"\x8aUC\x8c"),
+        (LENGTH_INT4, b"\x8bT"),
+        (LENGTH_UINT4, b"BX"),
+        (LENGTH_UINT8, b"\x8e\x96\x8d"),
+    ) for code in codes
+}
 
 
 def pickle_detect_python2(buffer: bytes):
@@ -254,22 +296,57 @@ def pickle_detect_python2(buffer: bytes):
     # then attributes will use BINUNICODE instead (like py3)
     # Most ren'py AST classes do use __slots__ so that's a bit annoying
 
-    for opcode, arg, pos in pickletools.genops(buffer):
-        if opcode.code == "\x80":
+    # Protocol 2 pickles that don't contain any of the bytes we're looking for after the
+    # PROTO opcode can't contain the opcodes either, which re can tell us in a single scan.
+    if buffer[:2] == b"\x80\x02" and PICKLE_DECIDING_BYTES.search(buffer, 2) is None:
+        return False
+
+    # pickletools.genops would decode every argument into a python object. We only need to
+    # find opcode boundaries, so step over the arguments using their encoded sizes instead.
+    pos = 0
+    end = len(buffer)
+    while pos < end:
+        code = buffer[pos]
+        pos += 1
+
+        if code == PICKLE_PROTO:
             # from what I know ren'py for now always uses protocol 2,
             # but it might've been different in the past, and change in the future
-            if arg < 2:
+            proto = buffer[pos]
+            if proto < 2:
                 return True
 
-            elif arg > 2:
+            elif proto > 2:
                 return False
 
-        if opcode.code in "TU":
+            pos += 1
+            continue
+
+        if code == PICKLE_BINSTRING or code == PICKLE_SHORT_BINSTRING:
             return True
 
+        if code == PICKLE_STOP:
+            return False
+
+        try:
+            size = PICKLE_ARG_SIZES[code]
+        except KeyError:
+            raise ValueError(f'at position {pos - 1}, opcode {bytes((code,))!r} unknown')
+
+        if size >= 0:
+            pos += size
+        elif size == UP_TO_NEWLINE:
+            pos = buffer.index(b'\n', pos) + 1
+        elif size == NEWLINE_PAIR:
+            pos = buffer.index(b'\n', buffer.index(b'\n', pos) + 1) + 1
+        else:
+            fmt, length = PICKLE_LENGTH_PREFIXES[size]
+            pos += length + struct.unpack_from(fmt, buffer, pos)[0]
+
     return False
 
 
+
 # AST Default Values for Ren'Py 8.4.0 compatibility
 AST_DEFAULT_VALUES = {
     'Label': {
@@ -386,60 +463,37 @@ AST_DEFAULT_VALUES = {
     },
 }
 
-def apply_ast_defaults(ast_obj, ast_type):
-    """Apply default values to AST objects for Ren'Py 8.4.0 compatibility."""
-    if ast_type in AST_DEFAULT_VALUES:
-        defaults = AST_DEFAULT_VALUES[ast_type]
-        for attr, default_value in defaults.items():
-            if not hasattr(ast_obj, attr):
-                setattr(ast_obj, attr, default_value)
-    return ast_obj
-
-
-def fix_ast_for_renpy_84(stmts):
-    """Fix AST objects for Ren'Py 8.4.0 compatibility by applying default values."""
-    if not stmts:
-        return stmts
-    
-    def fix_ast_node(node):
-        """Recursively fix an AST node and its children."""
-        if hasattr(node, '__class__'):
-            class_name = node.__class__.__name__
-            apply_ast_defaults(node, class_name)
-        
-        # Handle special attribute mapping for Label class
-        if hasattr(node, '__class__') and node.__class__.__name__ == 'Label':
-            if hasattr(node, '_name') and not hasattr(node, 'name'):
-                node.name = node._name
-        
-        # Recursively fix child nodes
-        if hasattr(node, 'block') and isinstance(node.block, list):
-            for child in node.block:
-                fix_ast_node(child)
-        
-        if hasattr(node, 'entries') and isinstance(node.entries, list):
-            for entry in node.entries:
-                if isinstance(entry, tuple) and len(entry) >= 3:
-                    # Menu entries: (condition, label, block)
-                    if entry[2]:  # block
-                        for child in entry[2]:
-                            fix_ast_node(child)
-        
-        if hasattr(node, 'items') and isinstance(node.items, list):
-            for item in node.items:
-                if isinstance(item, tuple) and len(item) >= 3:
-                    # Menu items: (label, condition, block)
-                    if item[2]:  # block
-                        for child in item[2]:
-                            fix_ast_node(child)
-        
-        return node
-    
-    # Fix all statements in the list
-    for stmt in stmts:
-        fix_ast_node(stmt)
-    
-    return stmts
+def _make_defaulter(node_type, defaults):
+    # Builds the function filling the missing attributes of one node type into a node's
+    # __dict__. The mutable defaults are all empty, so they're replaced by their type and
+    # every node that needs one gets a fresh object instead of sharing it.
+    items = tuple((attr, None, type(default)) if isinstance(default, (list, dict))
+                  else (attr, default, None)
+                  for attr, default in defaults.items() if attr != '_name')
+    rename_to_name = node_type == 'Label'
+
+    def fill(d):
+        # 8.4.0 renamed name to _name
+        if rename_to_name and 'name' not in d:
+            d['name'] = d.get('_name')
+
+        for attr, default, factory in items:
+            if attr not in d:
+                d[attr] = default if factory is None else factory()
+
+    return fill
+
+
+# The filler function for each class name in AST_DEFAULT_VALUES
+AST_DEFAULTERS = {
+    node_type: _make_defaulter(node_type, defaults)
+    for node_type, defaults in AST_DEFAULT_VALUES.items()
+}
+
+
+# Bump this whenever fix_ast_for_renpy_84 or AST_DEFAULT_VALUES changes what ends up in
+# the AST, so ASTs cached by unrpyc's --ast-cache get rebuilt.
+RENPY_84_FIX_VERSION = 1
 
 
 def fix_ast_for_renpy_84(ast_nodes):
@@ -448,161 +502,34 @@ def fix_ast_for_renpy_84(ast_nodes):
     """
     if not isinstance(ast_nodes, list):
         ast_nodes = [ast_nodes]
-    
-    for node in ast_nodes:
+
+    # Walk the tree with an explicit stack, deeply nested scripts would otherwise
+    # recurse once per block.
+    stack = list(ast_nodes)
+    push = stack.extend
+    while stack:
+        node = stack.pop()
         node_type = type(node).__name__
-        
+        d = getattr(node, '__dict__', None)
+
         # Apply defaults based on node type
-        if node_type == 'Label':
-            if not hasattr(node, 'parameters'):
-                node.parameters = None
-            if not hasattr(node, 'name'):
-                node.name = getattr(node, '_name', None)
-            if not hasattr(node, 'block'):
-                node.block = []
-                
-        elif node_type == 'Scene':
-            if not hasattr(node, 'atl'):
-                node.atl = None
-            if not hasattr(node, 'imspec'):
-                node.imspec = None
-            if not hasattr(node, 'layer'):
-                node.layer = None
-            if not hasattr(node, 'onlayer'):
-                node.onlayer = None
-                
-        elif node_type == 'Show':
-            if not hasattr(node, 'imspec'):
-                node.imspec = None
-            if not hasattr(node, 'atl'):
-                node.atl = None
-            if not hasattr(node, 'layer'):
-                node.layer = None
-            if not hasattr(node, 'at_list'):
-                node.at_list = []
-            if not hasattr(node, 'onlayer'):
-                node.onlayer = None
-            if not hasattr(node, 'behind'):
-                node.behind = []
-            if not hasattr(node, 'zorder'):
-                node.zorder = None
-            if not hasattr(node, 'as_'):
-                node.as_ = None
-                
-        elif node_type == 'Hide':
-            if not hasattr(node, 'imspec'):
-                node.imspec = None
-            if not hasattr(node, 'atl'):
-                node.atl = None
-            if not hasattr(node, 'layer'):
-                node.layer = None
-            if not hasattr(node, 'onlayer'):
-                node.onlayer = None
-                
-        elif node_type == 'Say':
-            if not hasattr(node, 'who'):
-                node.who = None
-            if not hasattr(node, 'what'):
-                node.what = None
-            if not hasattr(node, 'with_'):
-                node.with_ = None
-            if not hasattr(node, 'interact'):
-                node.interact = True
-            if not hasattr(node, 'attributes'):
-                node.attributes = None
-            if not hasattr(node, 'temporary_attributes'):
-                node.temporary_attributes = None
-            if not hasattr(node, 'rollback'):
-                node.rollback = None
-                
-        elif node_type == 'Menu':
-            if not hasattr(node, 'items'):
-                node.items = []
-            if not hasattr(node, 'set'):
-                node.set = None
-            if not hasattr(node, 'with_'):
-                node.with_ = None
-            if not hasattr(node, 'rollback'):
-                node.rollback = None
-                
-        elif node_type == 'With':
-            if not hasattr(node, 'expr'):
-                node.expr = None
-            if not hasattr(node, 'paired'):
-                node.paired = None
-                
-        elif node_type == 'Jump':
-            if not hasattr(node, 'target'):
-                node.target = None
-            if not hasattr(node, 'expression'):
-                node.expression = False
-                
-        elif node_type == 'Call':
-            if not hasattr(node, 'label'):
-                node.label = None
-            if not hasattr(node, 'arguments'):
-                node.arguments = None
-            if not hasattr(node, 'expression'):
-                node.expression = False
-            if not hasattr(node, 'from_current'):
-                node.from_current = False
-                
-        elif node_type == 'Return':
-            if not hasattr(node, 'expression'):
-                node.expression = None
-                
+        fill = AST_DEFAULTERS.get(node_type)
+        if fill is not None and d is not None:
+            fill(d)
+
+        # Nested blocks. The unpickled attributes all live in the instance dict.
+        block = d.get('block') if d is not None else getattr(node, 'block', None)
+        if block:
+            push(block if isinstance(block, list) else (block,))
+
+        # Menu items are (label, condition, block), if entries are (condition, block)
+        if node_type == 'Menu':
+            for item in d['items']:
+                if item[2]:
+                    push(item[2])
         elif node_type == 'If':
-            if not hasattr(node, 'entries'):
-                node.entries = []
-                
-        elif node_type == 'While':
-            if not hasattr(node, 'condition'):
-                node.condition = None
-            if not hasattr(node, 'block'):
-                node.block = []
-                
-        elif node_type == 'Init':
-            if not hasattr(node, 'priority'):
-                node.priority = 0
-            if not hasattr(node, 'block'):
-                node.block = []
-                
-        elif node_type == 'Image':
-            if not hasattr(node, 'imgname'):
-                node.imgname = None
-            if not hasattr(node, 'code'):
-                node.code = None
-            if not hasattr(node, 'atl'):
-                node.atl = None
-                
-        elif node_type == 'Transform':
-            if not hasattr(node, 'varname'):
-                node.varname = None
-            if not hasattr(node, 'parameters'):
-                node.parameters = None
-            if not hasattr(node, 'code'):
-                node.code = None
-            if not hasattr(node, 'atl'):
-                node.atl = None
-                
-        elif node_type == 'Python':
-            if not hasattr(node, 'code'):
-                node.code = None
-            if not hasattr(node, 'hide'):
-                node.hide = False
-            if not hasattr(node, 'store'):
-                node.store = 'store'
-                
-        elif node_type == 'UserStatement':
-            if not hasattr(node, 'line'):
-                node.line = None
-            if not hasattr(node, 'block'):
-                node.block = []
-            if not hasattr(node, 'parsed'):
-                node.parsed = None
-        
-        # Recursively fix nested blocks
-        if hasattr(node, 'block') and node.block:
-            fix_ast_for_renpy_84(node.block)
-    
+            for entry in d['entries']:
+                if entry[1]:
+                    push(entry[1])
+
     return ast_nodes
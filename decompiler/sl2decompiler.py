@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from .util import DecompilerBase, First, reconstruct_paraminfo, \
+from .util import DecompilerBase, reconstruct_paraminfo, \
                   reconstruct_arginfo, split_logical_lines, Dispatcher
 
 from . import atldecompiler
@@ -46,22 +46,34 @@ class SL2Decompiler(DecompilerBase):
     def __init__(self, out_file, options):
         super(SL2Decompiler, self).__init__(out_file, options)
 
+        # 和Decompiler一样，预先把dispatch中的未绑定方法解析为绑定方法
+        self._dispatch_local = {cls: func.__get__(self, type(self))
+                                for cls, func in self.dispatch.items()}
+        # 用户通过--sl-custom-names注册的 显示组件名称: (名称, 子元素数量)
+        self._custom_names = options.sl_custom_names or {}
+
     # 这个字典是 类: 未绑定方法 的映射，用于确定对哪个 slast 类调用什么方法
     dispatch = Dispatcher()
 
     def print_node(self, ast):
         self.advance_to_line(ast.location[1])
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        # 未知节点很少见，所以命中路径上不需要.get()的默认值处理
+        try:
+            method = self._dispatch_local[type(ast)]
+        except KeyError:
+            method = self.print_unknown
+        method(ast)
 
     @dispatch(sl2.slast.SLScreen)
     def print_screen(self, ast):
 
         # 打印屏幕语句并创建块
         self.indent()
-        self.write(f'screen {ast.name}')
         # 如果有参数，打印它们
         if ast.parameters:
-            self.write(reconstruct_paraminfo(ast.parameters))
+            self.write(f'screen {ast.name}{reconstruct_paraminfo(ast.parameters)}')
+        else:
+            self.write(f'screen {ast.name}')
 
         # 打印内容
         first_line, other_lines = self.sort_keywords_and_children(ast)
@@ -85,7 +97,6 @@ class SL2Decompiler(DecompilerBase):
 
     def _print_if(self, ast, keyword):
         # 第一个条件命名为 if 或 showif，其余为 elif
-        keyword = First(keyword, "elif")
         for condition, block in ast.entries:
             self.advance_to_line(block.location[1])
             self.indent()
@@ -93,7 +104,8 @@ class SL2Decompiler(DecompilerBase):
             if condition is None:
                 self.write("else")
             else:
-                self.write(f'{keyword()} {condition}')
+                self.write(f'{keyword} {condition}')
+                keyword = "elif"
 
             # 每个条件都有一个 slast.SLBlock 类型的块
             self.print_block(block, immediate_block=True)
@@ -137,7 +149,7 @@ class SL2Decompiler(DecompilerBase):
             children = ast.children
 
         self.indent()
-        if hasattr(ast, "index_expression") and ast.index_expression is not None:
+        if getattr(ast, "index_expression", None) is not None:
             self.write(f'for {variable}index {ast.index_expression} in {ast.expression}:')
 
         else:
@@ -181,20 +193,17 @@ class SL2Decompiler(DecompilerBase):
     def print_use(self, ast):
         # use 语句需要重构它想要传递的参数
         self.indent()
-        self.write("use ")
-        args = reconstruct_arginfo(ast.args)
+        args = "" if ast.args is None else reconstruct_arginfo(ast.args)
         if isinstance(ast.target, PyExpr):
-            self.write(f'expression {ast.target}')
-            if args:
-                self.write(" pass ")
+            line = f'use expression {ast.target}{" pass " if args else ""}{args}'
         else:
-            self.write(f'{ast.target}')
+            line = f'use {ast.target}{args}'
 
-        self.write(f'{args}')
-        if hasattr(ast, 'id') and ast.id is not None:
-            self.write(f' id {ast.id}')
+        if getattr(ast, 'id', None) is not None:
+            line = f'{line} id {ast.id}'
+        self.write(line)
 
-        if hasattr(ast, "block") and ast.block:
+        if getattr(ast, "block", None):
             self.print_block(ast.block)
 
     @dispatch(sl2.slast.SLTransclude)
@@ -212,14 +221,14 @@ class SL2Decompiler(DecompilerBase):
     def print_displayable(self, ast, has_block=False):
         # slast.SLDisplayable 表示各种语句。我们可以通过分析调用的显示组件和样式属性
         # 来确定它表示什么语句。
-        key = (ast.displayable, ast.style)
-        nameAndChildren = self.displayable_names.get(key)
+        nameAndChildren = self.lookup_displayable_name(ast.displayable, ast.style)
 
-        if nameAndChildren is None and self.options.sl_custom_names:
+        if nameAndChildren is None and self._custom_names:
             # 检查我们是否为这个显示组件注册了名称
-            nameAndChildren = self.options.sl_custom_names.get(ast.displayable.__name__)
-            self.print_debug(
-                f'为显示组件 {ast.displayable} 替换了名称 "{nameAndChildren[0]}"')
+            nameAndChildren = self._custom_names.get(ast.displayable.__name__)
+            if nameAndChildren is not None:
+                self.print_debug(
+                    f'为显示组件 {ast.displayable} 替换了名称 "{nameAndChildren[0]}"')
 
         if nameAndChildren is None:
             # 这是一个我们不了解的（用户定义的）显示组件。
@@ -234,9 +243,10 @@ class SL2Decompiler(DecompilerBase):
 
         (name, children) = nameAndChildren
         self.indent()
-        self.write(name)
         if ast.positional:
-            self.write(" " + " ".join(ast.positional))
+            self.write(f'{name} {" ".join(ast.positional)}')
+        else:
+            self.write(name)
 
         atl_transform = getattr(ast, 'atl_transform', None)
         # AST 不包含是否使用了 "has" 块的指示。
@@ -327,6 +337,24 @@ class SL2Decompiler(DecompilerBase):
         (ui._textbutton, 0):                    ("textbutton", 0),
     }
 
+    # displayable_names的查找结果: id(显示组件) -> (显示组件, {样式: 结果})
+    # 显示组件是伪类，它们的__hash__和__eq__是python代码，所以(显示组件, 样式)元组
+    # 每次查找都要调用它们。这里按id缓存，保存对象本身以防id被重用
+    _displayable_name_cache = {}
+
+    def lookup_displayable_name(self, displayable, style):
+        cache = self._displayable_name_cache
+        entry = cache.get(id(displayable))
+        if entry is None or entry[0] is not displayable:
+            entry = cache[id(displayable)] = (displayable, {})
+
+        by_style = entry[1]
+        try:
+            return by_style[style]
+        except KeyError:
+            result = by_style[style] = self.displayable_names.get((displayable, style))
+            return result
+
     def sort_keywords_and_children(self, node, immediate_block=False, ignore_children=False):
         # 对具有关键字和子元素的 SL 语句的内容进行排序
         # 返回排序内容的列表。
@@ -354,9 +382,10 @@ class SL2Decompiler(DecompilerBase):
 
         # 关键字
         # 7.7/8.2 之前：行末的关键字可以没有参数，解析器对此是可以接受的。
-        keywords_by_line = [(value.linenumber if value else None,
-                             "keyword" if value else "broken",
-                             (name, value)) for name, value in keywords]
+        # 损坏的关键字必须留在原来的位置，所以不能拆成两个列表再拼接
+        keywords_by_line = [(value.linenumber, "keyword", (name, value)) if value
+                            else (None, "broken", (name, value))
+                            for name, value in keywords]
 
         # 子元素
         children_by_line = [(child.location[1], "child", child) for child in children]
@@ -367,25 +396,26 @@ class SL2Decompiler(DecompilerBase):
 
         # 将关键字和子元素合并到单个有序列表中
         # 行号、类型、内容的列表
+        # 这是按两个列表的头部进行的归并，而不是排序：排序会打乱行号错误的内容，
+        # 并且会把所有损坏的关键字移到最前面。
         contents_in_order = []
-        keywords_by_line.reverse()
-        children_by_line.reverse()
-        while keywords_by_line and children_by_line:
+        append = contents_in_order.append
+        keyword_index = child_index = 0
+        keyword_count = len(keywords_by_line)
+        child_count = len(children_by_line)
+        while keyword_index < keyword_count and child_index < child_count:
+            keyword = keywords_by_line[keyword_index]
             # 损坏的关键字：总是在任何子元素之前输出，这样我们可以轻松地将它们与之前的关键字合并
-            if keywords_by_line[-1][0] is None:
-                contents_in_order.append(keywords_by_line.pop())
-
-            elif keywords_by_line[-1][0] < children_by_line[-1][0]:
-                contents_in_order.append(keywords_by_line.pop())
+            if keyword[0] is None or keyword[0] < children_by_line[child_index][0]:
+                append(keyword)
+                keyword_index += 1
 
             else:
-                contents_in_order.append(children_by_line.pop())
-
-        while keywords_by_line:
-            contents_in_order.append(keywords_by_line.pop())
+                append(children_by_line[child_index])
+                child_index += 1
 
-        while children_by_line:
-            contents_in_order.append(children_by_line.pop())
+        contents_in_order.extend(keywords_by_line[keyword_index:])
+        contents_in_order.extend(children_by_line[child_index:])
 
         # 如果存在，合并 at transform
         if atl_transform is not None:
@@ -544,8 +574,6 @@ class SL2Decompiler(DecompilerBase):
         return contents_grouped[0], contents_grouped[1:]
 
     def print_keyword_or_child(self, item, first_line=False, has_block=False):
-        sep = First(" " if first_line else "", " ")
-
         lineno = item[0]
         ty = item[1]
 
@@ -557,14 +585,13 @@ class SL2Decompiler(DecompilerBase):
             self.advance_to_line(lineno)
             self.indent()
 
-        for name, value in item[2]:
-            self.write(sep())
-            self.write(f'{name} {value}')
+        # 整行在一次write中输出。第一行的内容要与前面的语句用空格隔开
+        parts = [f'{name} {value}' for name, value in item[2]]
 
         if ty == "keywords_atl":
             assert not has_block, "不能在与 at transform 块同一行开始块"
-            self.write(sep())
-            self.write("at transform:")
+            parts.append("at transform:")
+            self.write((" " if first_line else "") + " ".join(parts))
 
             self.linenumber = atldecompiler.pprint(
                 self.out_file, item[3], self.options,
@@ -574,8 +601,11 @@ class SL2Decompiler(DecompilerBase):
             return
 
         if ty == "keywords_broken":
-            self.write(sep())
-            self.write(item[3])
+            parts.append(str(item[3]))
 
+        line = (" " if first_line else "") + " ".join(parts) if parts else ""
         if first_line and has_block:
-            self.write(":")
+            line += ":"
+
+        if line:
+            self.write(line)
@@ -42,7 +42,13 @@ class TestcaseDecompiler(DecompilerBase):
     def print_node(self, ast):
         if hasattr(ast, 'linenumber'):
             self.advance_to_line(ast.linenumber)
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+        # A new instance is made for every block, so binding the table per instance like
+        # Decompiler does wouldn't pay off. Unknown nodes are rare, so skip .get() instead.
+        try:
+            method = self.dispatch[type(ast)]
+        except KeyError:
+            method = type(self).print_unknown
+        method(self, ast)
 
     @dispatch(testast.Python)
     def print_python(self, ast):
@@ -100,7 +106,7 @@ class TestcaseDecompiler(DecompilerBase):
             self.write(f'type {ast.keys[0]}')
         if ast.pattern is not None:
             self.write(f' pattern "{string_escape(ast.pattern)}"')
-        if hasattr(ast, 'position') and ast.position is not None:
+        if getattr(ast, 'position', None) is not None:
             self.write(f' pos {ast.position}')
 
     @dispatch(testast.Drag)
@@ -128,11 +134,11 @@ class TestcaseDecompiler(DecompilerBase):
             self.write(f'"{string_escape(ast.pattern)}"')
         else:
             self.write("click")
-        if hasattr(ast, 'button') and ast.button != 1:
+        if getattr(ast, 'button', 1) != 1:
             self.write(f' button {ast.button}')
-        if hasattr(ast, 'position') and ast.position is not None:
+        if getattr(ast, 'position', None) is not None:
             self.write(f' pos {ast.position}')
-        if hasattr(ast, 'always') and ast.always:
+        if getattr(ast, 'always', False):
             self.write(" always")
 
     @dispatch(testast.Scroll)
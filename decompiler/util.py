@@ -30,7 +30,18 @@ class OptionBase:
         self.log = [] if log is None else log
 
 
+class _State:
+    """
+    save_state保存的反编译器状态。子类通过扩展__slots__添加自己的字段
+    """
+    __slots__ = ('out_file', 'skip_indent_until_write', 'linenumber', 'block_stack',
+                 'index_stack', 'indent_level', 'blank_line_queue')
+
+
 class DecompilerBase:
+    # save_state创建的状态对象类型
+    state_class = _State
+
     def __init__(self, out_file=None, options=OptionBase()):
         # 反编译器输出到的文件对象
         self.out_file = out_file or sys.stdout
@@ -57,6 +68,12 @@ class DecompilerBase:
         # 存储任何可以在有空行时发出的内容
         self.blank_line_queue = []
 
+        # 已提交或回滚的状态对象，供save_state重复使用
+        self._state_pool = []
+
+        # 每个缩进级别的换行加缩进字符串，由indent()按需填充
+        self._indent_strings = {}
+
     def dump(self, ast, indent_level=0, linenumber=1, skip_indent_until_write=False):
         """
         将`ast`的反编译表示写入构造函数中给定的打开文件
@@ -101,13 +118,15 @@ class DecompilerBase:
         """
         Save our current state.
         """
-        state = (self.out_file,
-                 self.skip_indent_until_write,
-                 self.linenumber,
-                 self.block_stack,
-                 self.index_stack,
-                 self.indent_level,
-                 self.blank_line_queue)
+        pool = self._state_pool
+        state = pool.pop() if pool else self.state_class()
+        state.out_file = self.out_file
+        state.skip_indent_until_write = self.skip_indent_until_write
+        state.linenumber = self.linenumber
+        state.block_stack = self.block_stack
+        state.index_stack = self.index_stack
+        state.indent_level = self.indent_level
+        state.blank_line_queue = self.blank_line_queue
         self.out_file = StringIO()
         return state
 
@@ -115,21 +134,25 @@ class DecompilerBase:
         """
         Commit changes since a saved state.
         """
-        out_file = state[0]
+        out_file = state.out_file
         out_file.write(self.out_file.getvalue())
         self.out_file = out_file
+        state.out_file = None
+        self._state_pool.append(state)
 
     def rollback_state(self, state):
         """
         Roll back to a saved state.
         """
-        (self.out_file,
-         self.skip_indent_until_write,
-         self.linenumber,
-         self.block_stack,
-         self.index_stack,
-         self.indent_level,
-         self.blank_line_queue) = state
+        self.out_file = state.out_file
+        self.skip_indent_until_write = state.skip_indent_until_write
+        self.linenumber = state.linenumber
+        self.block_stack = state.block_stack
+        self.index_stack = state.index_stack
+        self.indent_level = state.indent_level
+        self.blank_line_queue = state.blank_line_queue
+        state.out_file = None
+        self._state_pool.append(state)
 
     def advance_to_line(self, linenumber):
         # If there was anything that we wanted to do as soon as we found a blank line,
@@ -156,7 +179,11 @@ class DecompilerBase:
         calls the write method
         """
         if not self.skip_indent_until_write:
-            self.write('\n' + self.indentation * self.indent_level)
+            level = self.indent_level
+            string = self._indent_strings.get(level)
+            if string is None:
+                string = self._indent_strings[level] = '\n' + self.indentation * level
+            self.write(string)
 
     def print_nodes(self, ast, extra_indent=0):
         # This node is a list of nodes
@@ -201,6 +228,19 @@ class DecompilerBase:
     def print_node(self, ast):
         raise NotImplementedError()
 
+class ListWriter:
+    # A minimal file-like object which collects written strings in a list.
+    # Cheaper than StringIO when output is only temporarily redirected and
+    # consists of many small writes that are joined once at the end.
+    def __init__(self):
+        self.parts = []
+
+    def write(self, string):
+        self.parts.append(string)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
 class First:
     # An often used pattern is that on the first item
     # of a loop something special has to be done. This class
@@ -426,6 +466,11 @@ def simple_expression_guard(s):
 def split_logical_lines(s):
     return Lexer(s).split_logical_lines()
 
+def iter_logical_lines(s):
+    # like split_logical_lines, but yields the lines as they are found instead
+    # of building a list of them first
+    return Lexer(s).iter_logical_lines()
+
 class Lexer:
     # special lexer for simple_expressions the ren'py way
     # false negatives aren't dangerous. but false positives are
@@ -546,8 +591,10 @@ class Lexer:
         # split a sequence in logical lines
         # this behaves similarly to .splitlines() which will ignore
         # a trailing \n
-        lines = []
+        return list(self.iter_logical_lines())
 
+    def iter_logical_lines(self):
+        # generator version of split_logical_lines
         contained = 0
 
         startpos = self.pos
@@ -558,7 +605,7 @@ class Lexer:
             if (c == '\n'
                     and not contained
                     and (not self.pos or self.string[self.pos - 1] != '\\')):
-                lines.append(self.string[startpos:self.pos])
+                yield self.string[startpos:self.pos]
                 # the '\n' is not included in the emitted line
                 self.pos += 1
                 startpos = self.pos
@@ -584,8 +631,7 @@ class Lexer:
             self.re(r'\w+| +|.')  # consume a word, whitespace or one symbol
 
         if self.pos != startpos:
-            lines.append(self.string[startpos:])
-        return lines
+            yield self.string[startpos:]
 
 # Versions of Ren'Py prior to 6.17 put trailing whitespace on the end of
 # simple_expressions. This class attempts to preserve the amount of
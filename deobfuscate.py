@@ -31,6 +31,7 @@
 # 我们通过检查它们是否适合来处理这个问题。
 
 import base64
+import io
 import struct
 import zlib
 from collections import Counter
@@ -57,32 +58,42 @@ def decryptor(f):
 # 自定义提取/解密逻辑结束
 
 
-@extractor
-def extract_slot_rpyc(f, slot):
+SLOT_ENTRY_STRUCT = struct.Struct("<III")
+HEADERSCAN_STRUCT = struct.Struct("<IIIIIIIII")
+HEADERSCAN_FIRST_FIELD = struct.pack("<I", 1)
+
+def read_slot_table(data, position):
     """
-    用于实际rpyc格式文件的槽位提取器
+    读取从position开始的RPYC2槽位表，返回{槽位id: (起始位置, 长度)}
     """
-    f.seek(0)
-    data = f.read()
-    if data[:10] != b'RENPY RPC2':
-        raise ValueError("头部不正确")
-
-    position = 10
+    # iter_unpack需要整数个条目，所以截掉末尾不完整的条目，并且不复制数据
+    end = position + (len(data) - position) // SLOT_ENTRY_STRUCT.size * SLOT_ENTRY_STRUCT.size
     slots = {}
-
-    while position + 12 <= len(data):
-        slotid, start, length = struct.unpack("<III", data[position:position + 12])
-        if (slotid, start, length) == (0, 0, 0):
+    for slotid, start, length in SLOT_ENTRY_STRUCT.iter_unpack(memoryview(data)[position:end]):
+        if slotid == 0 and start == 0 and length == 0:
             break
 
         if start + length >= len(data):
             raise ValueError("损坏的槽位条目")
 
         slots[slotid] = (start, length)
-        position += 12
     else:
         raise ValueError("损坏的槽位头部结构")
 
+    return slots
+
+@extractor
+def extract_slot_rpyc(f, slot):
+    """
+    用于实际rpyc格式文件的槽位提取器
+    """
+    f.seek(0)
+    data = f.read()
+    if data[:10] != b'RENPY RPC2':
+        raise ValueError("头部不正确")
+
+    slots = read_slot_table(data, 10)
+
     if slot not in slots:
         raise ValueError("未知的槽位id")
 
@@ -115,29 +126,18 @@ def extract_slot_headerscan(f, slot):
     f.seek(0)
     data = f.read()
 
-    position = 0
-    while position + 36 < len(data):
-        a, b, c, d, e, f, g, h, i = struct.unpack("<IIIIIIIII", data[position:position + 36])
-        if a == 1 and d == 2 and g == 0 and b + c == e:
+    # 头部的第一个字段必须是1，所以用bytes.find直接跳到下一个这样的位置
+    position = data.find(HEADERSCAN_FIRST_FIELD)
+    while position != -1 and position + 36 < len(data):
+        a, b, c, d, e, f, g, h, i = HEADERSCAN_STRUCT.unpack_from(data, position)
+        if d == 2 and g == 0 and b + c == e:
             break
-        position += 1
+        position = data.find(HEADERSCAN_FIRST_FIELD, position + 1)
 
     else:
         raise ValueError("找不到头部")
 
-    slots = {}
-    while position + 12 <= len(data):
-        slotid, start, length = struct.unpack("<III", data[position:position + 12])
-        if (slotid, start, length) == (0, 0, 0):
-            break
-
-        if start + length >= len(data):
-            raise ValueError("损坏的槽位条目")
-
-        slots[slotid] = (start, length)
-        position += 12
-    else:
-        raise ValueError("损坏的槽位头部结构")
+    slots = read_slot_table(data, position)
 
     if slot not in slots:
         raise ValueError("未知的槽位id")
@@ -154,29 +154,25 @@ def extract_slot_zlibscan(f, slot):
     f.seek(0)
     data = f.read()
 
-    start_positions = []
-
-    for i in range(len(data) - 1):
-        if data[i] != 0x78:
-            continue
-
-        if (data[i] * 256 + data[i + 1]) % 31 != 0:
-            continue
-
-        start_positions.append(i)
-
-    chunks = []
-    for position in start_positions:
-        try:
-            chunk = zlib.decompress(data[position:])
-        except zlib.error:
-            continue
-        chunks.append(chunk)
-
-    if slot > len(chunks):
-        raise ValueError("Zlibscan未找到足够的块")
+    # bytes.find跳到每个可能的zlib头部，避免逐字节在python中循环。
+    # 解压时使用memoryview，这样不会为每个候选位置复制剩余的数据。
+    # 只保留计数，找到第slot个块就返回，不保存之前解压出的块。
+    view = memoryview(data)
+    found = 0
+    position = data.find(0x78, 0, len(data) - 1)
+    while position != -1:
+        if (0x7800 + data[position + 1]) % 31 == 0:
+            try:
+                chunk = zlib.decompress(view[position:])
+            except zlib.error:
+                pass
+            else:
+                found += 1
+                if found == slot:
+                    return chunk
+        position = data.find(0x78, position + 1, len(data) - 1)
 
-    return chunks[slot - 1]
+    raise ValueError("Zlibscan未找到足够的块")
 
 
 @decryptor
@@ -186,9 +182,14 @@ def decrypt_zlib(data, count):
     except zlib.error:
         return None
 
+# 各解密器允许出现的字节
+HEX_BYTES = frozenset(b"abcdefABCDEF0123456789")
+BASE64_BYTES = frozenset(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/=\n")
+PRINTABLE_ASCII_BYTES = frozenset(range(0x20, 0x80))
+
 @decryptor
 def decrypt_hex(data, count):
-    if not all(i in b"abcdefABCDEF0123456789" for i in count.keys()):
+    if not count.keys() <= HEX_BYTES:
         return None
     try:
         return data.decode("hex")
@@ -197,8 +198,7 @@ def decrypt_hex(data, count):
 
 @decryptor
 def decrypt_base64(data, count):
-    if not all(i in b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/=\n"
-               for i in count.keys()):
+    if not count.keys() <= BASE64_BYTES:
         return None
     try:
         return base64.b64decode(data)
@@ -207,7 +207,7 @@ def decrypt_base64(data, count):
 
 @decryptor
 def decrypt_string_escape(data, count):
-    if not all(i >= 0x20 and i < 0x80 for i in count.keys()):
+    if not count.keys() <= PRINTABLE_ASCII_BYTES:
         return None
     try:
         newdata = data.decode("unicode-escape").encode('latin1')
@@ -228,18 +228,15 @@ def assert_is_normal_rpyc(f):
     """
 
     f.seek(0)
-    header = f.read(1024)
+    data = f.read()
     f.seek(0)
 
-    if header[:10] != b'RENPY RPC2':
+    if data[:10] != b'RENPY RPC2':
         # 要么是旧版，要么有人搞乱了头部
 
         # 假设是旧版，看看这个东西是否是有效的zlib blob
-        raw_data = f.read()
-        f.seek(0)
-
         try:
-            uncompressed = zlib.decompress(raw_data)
+            uncompressed = zlib.decompress(data)
         except zlib.error:
             raise ValueError(
                 "未找到RENPY RPC2头部，但作为旧版文件的解释失败")
@@ -247,37 +244,75 @@ def assert_is_normal_rpyc(f):
         return uncompressed
 
     else:
-        if len(header) < 46:
+        if len(data) < 46:
             # 10字节头部 + 4 * 9字节内容表
-            return ValueError("文件太短")
+            raise ValueError("文件太短")
 
-        a, b, c, d, e, f, g, h, i = struct.unpack("<IIIIIIIII", header[10:46])
+        a, b, c, d, e, f, g, h, i = HEADERSCAN_STRUCT.unpack_from(data, 10)
 
         # 头部格式是否匹配默认的ren'py生成文件？
         if not (a == 1 and b == 46 and d == 2 and (g, h, i) == (0, 0, 0) and b + c == e):
-            return ValueError("头部数据异常，格式是否增加了额外字段？")
+            raise ValueError("头部数据异常，格式是否增加了额外字段？")
 
-        f.seek(b)
-        raw_data = f.read(c)
-        f.seek(0)
+        raw_data = data[b:b + c]
         if len(raw_data) != c:
-            return ValueError("头部数据与文件长度不兼容")
+            raise ValueError("头部数据与文件长度不兼容")
 
         try:
             uncompressed = zlib.decompress(raw_data)
         except zlib.error:
-            return ValueError("槽位1不包含zlib blob")
+            raise ValueError("槽位1不包含zlib blob")
 
-        if not uncompressed.endswith("."):
-            return ValueError("槽位1不包含简单的pickle")
+        if not uncompressed.endswith(b"."):
+            raise ValueError("槽位1不包含简单的pickle")
 
         return uncompressed
 
 
+# 上一个成功去混淆的文件使用的(提取器, [解密器...])。同一个游戏的文件通常
+# 使用相同的混淆方式，所以在完整搜索之前先尝试它。每个worker进程各有一份
+last_strategy = None
+
+def try_strategy(f, strategy):
+    """
+    直接按strategy提取并解密f，如果任何一步失败则返回None
+    """
+    extractor, decryptors = strategy
+    try:
+        raw_data = extractor(f, 1)
+    except ValueError:
+        return None
+
+    for decryptor in decryptors:
+        raw_data = decryptor(raw_data, Counter(raw_data))
+        if raw_data is None:
+            return None
+
+    try:
+        data, stmts = pickle_safe_loads(raw_data)
+    except Exception:
+        return None
+    return stmts
+
 def read_ast(f, context):
+    global last_strategy
     diagnosis = ["正在尝试去混淆文件:"]
 
-    raw_datas = set()
+    raw_datas = {}
+
+    # 只读取一次文件。从bytes创建的BytesIO共享该对象，所以每个提取器的
+    # f.seek(0); f.read()都直接返回同一个bytes，不会再次读取和复制
+    f.seek(0)
+    f = io.BytesIO(f.read())
+
+    if last_strategy is not None:
+        stmts = try_strategy(f, last_strategy)
+        if stmts is not None:
+            extractor, decryptors = last_strategy
+            diagnosis.append(f'上一个文件的策略 {extractor.__name__} 成功')
+            diagnosis.extend(f'执行了一轮 {decryptor.__name__}' for decryptor in decryptors)
+            context.log("\n".join(diagnosis))
+            return stmts
 
     for extractor in EXTRACTORS:
         try:
@@ -288,7 +323,8 @@ def read_ast(f, context):
             diagnosis.append(f'策略 {extractor.__name__} 失败: {chr(10).join(e.args)}')
         else:
             diagnosis.append(f'策略 {extractor.__name__} 成功')
-            raw_datas.add(data)
+            # 记住第一个得到这份数据的提取器
+            raw_datas.setdefault(data, extractor)
 
     if not raw_datas:
         diagnosis.append("所有策略都失败了。无法提取数据")
@@ -298,43 +334,53 @@ def read_ast(f, context):
         diagnosis.append("策略产生了不同的结果。尝试所有选项")
 
     data = None
-    for raw_data in raw_datas:
+    for raw_data, extractor in raw_datas.items():
+        decryptors = []
         try:
-            data, stmts, d = try_decrypt_section(raw_data)
+            data, stmts, d = try_decrypt_section(raw_data, decryptors)
         except ValueError as e:
             diagnosis.append(e.message)
         else:
             diagnosis.extend(d)
             context.log("\n".join(diagnosis))
+            last_strategy = (extractor, decryptors)
             return stmts
 
     diagnosis.append("所有策略都失败了。无法去混淆数据")
     raise ValueError("\n".join(diagnosis))
 
 
-def try_decrypt_section(raw_data):
+# 一个(data, stmts)元组的pickle只能以PROTO（协议2及以上）或MARK（协议0和1）开头
+PICKLE_TUPLE_STARTS = frozenset((b"\x80", b"("))
+
+def try_decrypt_section(raw_data, used_decryptors=None):
+    # 如果给出了used_decryptors列表，按顺序把成功执行的解密器添加到其中
     diagnosis = []
 
     layers = 0
     while layers < 10:
-        # 我们能加载它了吗？
-        try:
-            data, stmts = pickle_safe_loads(raw_data)
-        except Exception:
-            pass
-        else:
-            return data, stmts, diagnosis
+        # 我们能加载它了吗？只有看起来像pickle的数据才值得尝试
+        if raw_data[:1] in PICKLE_TUPLE_STARTS:
+            try:
+                data, stmts = pickle_safe_loads(raw_data)
+            except Exception:
+                pass
+            else:
+                return data, stmts, diagnosis
 
         layers += 1
         count = Counter(raw_data)
 
         for decryptor in DECRYPTORS:
             newdata = decryptor(raw_data, count)
-            if newdata is None:
+            # 返回输入本身也被认为失败，否则会在同一份数据上空转直到用完层数
+            if newdata is None or newdata == raw_data:
                 continue
             else:
                 raw_data = newdata
                 diagnosis.append(f'执行了一轮 {decryptor.__name__}')
+                if used_decryptors is not None:
+                    used_decryptors.append(decryptor)
                 break
         else:
             break
@@ -25,6 +25,9 @@ __url__ = "https://github.com/jiang0681/unrpyc/"
 
 import argparse
 import glob
+import hashlib
+import operator
+import os
 import struct
 import sys
 import traceback
@@ -32,17 +35,28 @@ import zlib
 from pathlib import Path
 
 try:
-    from multiprocessing import Pool, cpu_count
+    from multiprocessing import Pool, cpu_count, get_start_method, set_forkserver_preload
 except ImportError:
     # 当多进程不可用时提供必要的模拟支持
     def cpu_count():
         return 1
 
+    usable_cpu_count = cpu_count
+else:
+    def usable_cpu_count():
+        # 优先使用此进程被允许使用的CPU数量（受taskset/cgroups等限制），
+        # 而不是机器上的全部CPU数量
+        try:
+            return len(os.sched_getaffinity(0))
+        except AttributeError:
+            return cpu_count() or 1
+
 import decompiler
 import deobfuscate
 from decompiler import astdump, translate
 from decompiler.renpycompat import (pickle_safe_loads, pickle_safe_dumps, pickle_loads,
-                                    pickle_detect_python2)
+                                    pickle_detect_python2, pickle_optimize,
+                                    RENPY_84_FIX_VERSION)
 
 
 class Context:
@@ -82,42 +96,66 @@ class BadRpycException(Exception):
     pass
 
 
+# RPYC2槽位表中的一个条目: 槽位id, 起始位置, 长度
+SLOT_ENTRY = struct.Struct("III")
+# 槽位表每次读取的条目数。ren'py自己只写两个槽位
+SLOT_ENTRIES_PER_READ = 64
+
+
+def iter_slot_table(in_file):
+    """
+    从in_file的当前位置读取槽位表，产生(槽位, 起始位置, 长度)直到结束条目。
+    如果文件在结束条目之前结束，则直接停止。
+    """
+    while True:
+        block = in_file.read(SLOT_ENTRY.size * SLOT_ENTRIES_PER_READ)
+        usable = len(block) - len(block) % SLOT_ENTRY.size
+        for entry in SLOT_ENTRY.iter_unpack(memoryview(block)[:usable]):
+            if entry[0] == 0:
+                return
+            yield entry
+
+        if usable < SLOT_ENTRY.size * SLOT_ENTRIES_PER_READ:
+            return
+
+
+# rpyc中pickle的大致压缩比，用于预估解压后的大小
+ZLIB_EXPANSION_ESTIMATE = 6
+
+# unrpyc会处理的文件后缀，以及反编译后输出文件的后缀
+DECOMPILED_SUFFIXES = {'.rpyc': '.rpy', '.rpymc': '.rpym'}
+RPYC_SUFFIXES = tuple(DECOMPILED_SUFFIXES)
+
+
 # API
 
 def read_ast_from_file(in_file, context):
     # 读取rpyc v1或v2文件
     # v1文件只是一个包含一些数据和ast的zlib压缩pickle blob
     # v2文件包含一个基本的存档结构，可以解析以找到相同的blob
-    raw_contents = in_file.read()
-    file_start = raw_contents[:50]
+    # 只读取头部、槽位表和槽位1本身，而不是整个文件
+    file_start = in_file.read(50)
     is_rpyc_v1 = False
 
-    if not raw_contents.startswith(b"RENPY RPC2"):
+    if not file_start.startswith(b"RENPY RPC2"):
         # 如果头部不存在，它应该是RPYC V1文件，只是blob
-        contents = raw_contents
+        contents = file_start + in_file.read()
         is_rpyc_v1 = True
 
     else:
         # 解析存档结构
-        position = 10
+        in_file.seek(10)
         chunks = {}
         have_errored = False
 
-        for expected_slot in range(1, 0xFFFFFFFF):
-            slot, start, length = struct.unpack("III", raw_contents[position: position + 12])
-
-            if slot == 0:
-                break
-
+        for expected_slot, (slot, start, length) in enumerate(iter_slot_table(in_file), 1):
             if slot != expected_slot and not have_errored:
                 have_errored = True
 
                 context.log(
                     "警告: 遇到意外的槽位结构。文件头部结构可能已被更改。")
 
-            position += 12
-
-            chunks[slot] = raw_contents[start: start + length]
+            chunks[slot] = (start, length)
 
         if 1 not in chunks:
             context.set_state('bad_header')
@@ -125,10 +163,13 @@ def read_ast_from_file(in_file, context):
                 "无法从rpyc文件中找到正确的槽位进行加载。文件头部结构已被更改。"
                 f"文件头部: {file_start}")
 
-        contents = chunks[1]
+        start, length = chunks[1]
+        in_file.seek(start)
+        contents = in_file.read(length)
 
     try:
-        contents = zlib.decompress(contents)
+        # 以预计的解压后大小作为初始输出缓冲区，减少输出缓冲区的增长次数
+        contents = zlib.decompress(contents, bufsize=len(contents) * ZLIB_EXPANSION_ESTIMATE)
     except Exception:
         context.set_state('bad_header')
         raise BadRpycException(
@@ -153,31 +194,81 @@ def read_ast_from_file(in_file, context):
     return stmts
 
 
-def get_ast(in_file, try_harder, context):
+def get_ast_cache_file(in_file, try_harder, ast_cache):
+    """
+    返回in_file的AST在缓存目录ast_cache中的缓存文件路径。
+    文件的路径、修改时间和大小，以及unrpyc和AST修复的版本都是键的一部分，
+    因此其中任何一个改变都会使旧的缓存失效。
+    """
+    st = in_file.stat()
+    key = (f"{in_file.resolve()}|{st.st_mtime_ns}|{st.st_size}|{try_harder}|"
+           f"{__version__}|{RENPY_84_FIX_VERSION}")
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return Path(ast_cache) / f"{digest}.pkl"
+
+
+def get_ast(in_file, try_harder, context, ast_cache=None):
     """
     打开路径in_file处的rpyc文件以加载包含的AST。
     如果try_harder为True，将尝试绕过混淆技术。
     否则，将其作为普通rpyc文件加载。
+    如果给定了缓存目录ast_cache，AST会从那里加载或保存到那里，
+    这样未改变的文件在再次运行时无需解压和解析。
     """
+    cache_file = None
+    if ast_cache is not None:
+        cache_file = get_ast_cache_file(in_file, try_harder, ast_cache)
+        try:
+            # 缓存的内容来自不可信的rpyc文件，因此和rpyc本身一样用安全的unpickler加载
+            log_lines, ast = pickle_safe_loads(cache_file.read_bytes())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # 缓存已损坏，正常解析即可，稍后会覆盖它
+            context.log(f'警告: 无法加载AST缓存 {cache_file}，将重新解析: {e}')
+        else:
+            # 重放解析时产生的警告，使输出与未缓存时相同
+            context.log_contents.extend(log_lines)
+            return ast
+
+    log_start = len(context.log_contents)
     with in_file.open('rb') as in_file:
         if try_harder:
             ast = deobfuscate.read_ast(in_file, context)
         else:
             ast = read_ast_from_file(in_file, context)
+
+    if cache_file is not None:
+        log_lines = context.log_contents[log_start:]
+        try:
+            data = pickle_safe_dumps((log_lines, ast))
+            # 确认缓存能被加载回来，否则每次运行都只会重新解析并重写一个无用的缓存
+            pickle_safe_loads(data)
+
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # 先写入临时文件再替换，以免其他进程读到写了一半的缓存
+            temp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+            temp_file.write_bytes(data)
+            temp_file.replace(cache_file)
+        except Exception as e:
+            context.log(f'警告: 无法写入AST缓存 {cache_file}: {e}')
+
     return ast
 
 
 def decompile_rpyc(input_filename, context, overwrite=False, try_harder=False, dump=False,
                    comparable=False, no_pyexpr=False, translator=None, init_offset=False,
-                   sl_custom_names=None):
+                   sl_custom_names=None, ast_cache=None):
 
     # 输出文件名是输入文件名但扩展名为.rpy
     if dump:
         ext = '.txt'
-    elif input_filename.suffix == ('.rpyc'):
-        ext = '.rpy'
-    elif input_filename.suffix == ('.rpymc'):
-        ext = '.rpym'
+    else:
+        try:
+            ext = DECOMPILED_SUFFIXES[input_filename.suffix]
+        except KeyError:
+            raise ValueError(
+                f'无法确定 {input_filename} 的输出文件名：只支持.rpyc和.rpymc文件。') from None
     out_filename = input_filename.with_suffix(ext)
 
 
@@ -187,7 +278,7 @@ def decompile_rpyc(input_filename, context, overwrite=False, try_harder=False, d
         return
 
     context.log(f'正在反编译 {input_filename} 到 {out_filename.name} ...')
-    ast = get_ast(input_filename, try_harder, context)
+    ast = get_ast(input_filename, try_harder, context, ast_cache)
 
     with out_filename.open('w', encoding='utf-8') as out_file:
         if dump:
@@ -212,14 +303,17 @@ def worker_tl(arg_tup):
 
     try:
         context.log(f'正在从 {filename} 提取翻译...')
-        ast = get_ast(filename, args.try_harder, context)
+        ast = get_ast(filename, args.try_harder, context, args.ast_cache)
 
         tl_inst = translate.Translator(args.translate, True)
         tl_inst.translate_dialogue(ast)
 
         # 此对象必须发送回主进程，为此需要进行pickle。
         # 默认的pickler无法正确pickle伪类，因此在此处手动处理。
-        context.set_result(pickle_safe_dumps((tl_inst.dialogue, tl_inst.strings)))
+        # 这些数据会随每个反编译任务发送并在每个worker中加载，
+        # 因此先去掉未使用的memo操作码以缩小它。
+        context.set_result(pickle_optimize(
+            pickle_safe_dumps((tl_inst.dialogue, tl_inst.strings))))
         context.set_state("ok")
 
     except Exception as e:
@@ -230,6 +324,36 @@ def worker_tl(arg_tup):
     return context
 
 
+# 此进程上次合并的(翻译数据blobs, (dialogue, strings))
+_translator_cache = (None, None)
+
+
+def load_translator(blobs):
+    """
+    返回用于反编译一个文件的Translator。blobs是worker_tl为每个文件pickle的
+    (dialogue, strings)，按worklist顺序排列。每个worker进程只unpickle并合并一次，
+    之后每个文件得到一个共享dialogue和strings的新Translator，
+    因为Translator在翻译文件时会记录状态（标签和已用的标识符）。
+    """
+    global _translator_cache
+
+    cached_blobs, tables = _translator_cache
+    if cached_blobs != blobs:
+        tl_dialogue = {}
+        tl_strings = {}
+        for blob in blobs:
+            new_dialogue, new_strings = pickle_loads(blob)
+            tl_dialogue.update(new_dialogue)
+            tl_strings.update(new_strings)
+
+        tables = (tl_dialogue, tl_strings)
+        _translator_cache = (blobs, tables)
+
+    translator = translate.Translator(None)
+    translator.dialogue, translator.strings = tables
+    return translator
+
+
 def worker_common(arg_tup):
     """
     unrpyc的核心。arg_tup是(args, filename)。此worker将解压filename处的文件，
@@ -239,15 +363,14 @@ def worker_common(arg_tup):
     args, filename = arg_tup
     context = Context()
 
-    if args.translator:
-        args.translator = pickle_loads(args.translator)
+    translator = None if args.translator is None else load_translator(args.translator)
 
     try:
         decompile_rpyc(
             filename, context, overwrite=args.clobber, try_harder=args.try_harder,
             dump=args.dump, no_pyexpr=args.no_pyexpr, comparable=args.comparable,
             init_offset=args.init_offset, sl_custom_names=args.sl_custom_names,
-            translator=args.translator)
+            translator=translator, ast_cache=args.ast_cache)
 
     except Exception as e:
         context.set_error(e)
@@ -257,20 +380,47 @@ def worker_common(arg_tup):
     return context
 
 
+# 每个worker进程在被替换前最多处理的任务批次数
+MAX_TASKS_PER_WORKER = 64
+
+
+def run_indexed(arg_tup):
+    """
+    以(index, worker, worker_args)调用worker，并返回(index, result)，
+    以便乱序完成的结果可以按提交顺序放回。
+    """
+    index, worker, worker_args = arg_tup
+    return index, worker(worker_args)
+
+
 def run_workers(worker, common_args, private_args, parallelism):
     """
     使用多进程并行运行worker，最多使用`parallelism`个进程。
     Workers被调用为worker((common_args, private_args[i]))。
     Workers应该返回`Context`的实例作为返回值。
+    返回的结果与private_args的顺序一致。
     """
 
     worker_args = ((common_args, x) for x in private_args)
 
     results = []
     if parallelism > 1:
-        with Pool(parallelism) as pool:
-            for result in pool.imap(worker, worker_args, 1):
-                results.append(result)
+        # 按完成顺序接收结果，这样一个仍在处理的大文件不会挡住已完成的小文件的日志。
+        # 每个进程大约分到四批任务，以减少进程间通信的次数。
+        chunksize = max(1, len(private_args) // (parallelism * 4))
+        indexed_args = ((i, worker, x) for i, x in enumerate(worker_args))
+        results = [None] * len(private_args)
+
+        # 使用forkserver时（例如Python 3.14起的Linux），让forkserver预先导入反编译器，
+        # 这样每个worker都从已导入这些模块的进程fork出来，而不必各自重新导入一遍。
+        # fork本身就共享主进程已导入的模块，而spawn无法预加载。
+        if get_start_method() == "forkserver":
+            set_forkserver_preload(["decompiler", "deobfuscate"])
+
+        # 定期替换worker进程，使长时间运行时每个worker的内存不会无限增长
+        with Pool(parallelism, maxtasksperchild=MAX_TASKS_PER_WORKER) as pool:
+            for index, result in pool.imap_unordered(run_indexed, indexed_args, chunksize):
+                results[index] = result
 
                 for line in result.log_contents:
                     print(line)
@@ -336,7 +486,7 @@ def main():
             f"您正在运行 {sys.version}")
 
     # argparse用法: python3 unrpyc.py [-c] [--try-harder] [-d] [-p] file [file ...]
-    cc_num = cpu_count()
+    cc_num = usable_cpu_count()
     ap = argparse.ArgumentParser(description="反编译 .rpyc/.rpymc 文件")
 
     ap.add_argument(
@@ -365,7 +515,7 @@ def main():
         dest='processes',
         action='store',
         type=int,
-        choices=list(range(1, cc_num)),
+        choices=list(range(1, cc_num + 1)),
         default=cc_num - 1 if cc_num > 2 else 1,
         help="使用指定数量的进程进行反编译。"
         "默认为可用硬件线程数减一，当多进程不可用时禁用。")
@@ -420,6 +570,21 @@ def main():
         action='store',
         help="使用tl目录中已存在的翻译更改反编译脚本文件中的对话语言。")
 
+    ap.add_argument(
+        '--ast-cache',
+        dest='ast_cache',
+        action='store_true',
+        help="缓存解析出的AST，再次处理未改变的文件时直接从缓存加载，无需重新解压和解析。")
+
+    ap.add_argument(
+        '--ast-cache-dir',
+        dest='ast_cache_dir',
+        type=str,
+        action='store',
+        default=None,
+        metavar='DIR',
+        help="仅用于--ast-cache，指定AST缓存的目录。默认为~/.cache/unrpyc/ast。")
+
     ap.add_argument(
         '--version',
         action='version',
@@ -434,6 +599,15 @@ def main():
     if args.dump and args.translate:
         ap.error("选项 '--translate' 和 '--dump' 不能同时使用。")
 
+    if args.ast_cache_dir is not None and not args.ast_cache:
+        ap.error("选项 '--ast-cache-dir' 需要 '--ast-cache'。")
+
+    # 之后args.ast_cache是缓存目录，没有启用缓存时为None
+    if args.ast_cache:
+        args.ast_cache = args.ast_cache_dir or str(Path.home() / ".cache" / "unrpyc" / "ast")
+    else:
+        args.ast_cache = None
+
     if args.sl_custom_names is not None:
         try:
             args.sl_custom_names = parse_sl_custom_names(args.sl_custom_names)
@@ -450,21 +624,46 @@ def main():
 
     def traverse(inpath):
         """
-        从输入路径筛选rpyc/rpymc文件并返回它们。通过调用自身递归进入所有给定目录。
+        从输入路径筛选rpyc/rpymc文件，并以(文件大小, 路径)的形式返回它们。
+        使用os.scandir和一个迭代器栈按原来的深度优先顺序进入所有给定目录，
+        这样目录项的类型可以直接从scandir得到，而不需要为每一项单独stat。
         """
-        if inpath.is_file() and inpath.suffix in ['.rpyc', '.rpymc']:
-            yield inpath
-        elif inpath.is_dir():
-            for item in inpath.iterdir():
-                yield from traverse(item)
+        if inpath.is_file():
+            if inpath.suffix in RPYC_SUFFIXES:
+                yield inpath.stat().st_size, inpath
+            return
+
+        if not inpath.is_dir():
+            return
+
+        stack = [os.scandir(inpath)]
+        try:
+            while stack:
+                for item in stack[-1]:
+                    if item.is_dir():
+                        stack.append(os.scandir(item.path))
+                        break
+
+                    if item.name.endswith(RPYC_SUFFIXES) and item.is_file():
+                        yield item.stat().st_size, Path(item.path)
+
+                else:
+                    stack.pop().close()
+        finally:
+            for iterator in stack:
+                iterator.close()
 
     # 通过globing和pathlib检查来自argparse的路径。构造一个包含所有
     # `Ren'Py编译文件`的任务列表，该应用程序被分配处理。
-    worklist = []
+    sized_worklist = []
     for entry in args.file:
         for globitem in glob_or_complain(entry):
-            for elem in traverse(globitem):
-                worklist.append(elem)
+            sized_worklist.extend(traverse(globitem))
+
+    # 如果大文件在接近尾声时开始，可能会有很长时间只有一个线程在运行，
+    # 这是低效的。通过首先启动大文件来避免这种情况。
+    sized_worklist.sort(key=operator.itemgetter(0), reverse=True)
+    worklist = [path for _, path in sized_worklist]
 
     # 检查我们是否确实有文件。不用担心没有传递参数，
     # 因为ArgumentParser会捕获这种情况
@@ -478,40 +677,30 @@ def main():
     print(f"找到 {plural_s(len(worklist), 'file')} 要处理。"
           f"使用 {plural_s(args.processes, 'worker')} 执行反编译。")
 
-    # 如果大文件在接近尾声时开始，可能会有很长时间只有一个线程在运行，
-    # 这是低效的。通过首先启动大文件来避免这种情况。
-    worklist.sort(key=lambda x: x.stat().st_size, reverse=True)
-
     translation_errors = 0
     args.translator = None
     if args.translate:
         # 对于翻译，我们首先需要分析所有文件的翻译数据。
-        # 然后我们将所有这些收集回主进程，并构建一个
-        # 包含所有这些的数据结构。然后将此数据结构传递给
-        # 所有反编译进程。
+        # 然后将每个文件的数据传递给所有反编译进程，由它们各自合并
+        # 成一个包含所有这些的数据结构。
         # 注意：因为此数据包含一些FakeClasses，多进程无法
         # 在进程之间传递它（它会pickle它们，pickle会抱怨
-        # 这些）。因此，我们需要手动pickle和unpickle它。
+        # 这些）。因此，worker_tl手动pickle它，而主进程只转发
+        # 这些pickle数据，不再为了合并而unpickle并重新pickle一遍。
 
         print("步骤1: 分析文件以获取翻译。")
         results = run_workers(worker_tl, args, worklist, args.processes)
 
         print('编译提取的翻译。')
-        tl_dialogue = {}
-        tl_strings = {}
+        tl_blobs = []
         for entry in results:
             if entry.state != "ok":
                 translation_errors += 1
 
             if entry.value:
-                new_dialogue, new_strings = pickle_loads(entry.value)
-                tl_dialogue.update(new_dialogue)
-                tl_strings.update(new_strings)
-
-        translator = translate.Translator(None)
-        translator.dialogue = tl_dialogue
-        translator.strings = tl_strings
-        args.translator = pickle_safe_dumps(translator)
+                tl_blobs.append(entry.value)
+
+        args.translator = tuple(tl_blobs)
 
         print("步骤2: 反编译。")
 